@@ -6,7 +6,8 @@ Hackアセンブラ
         self.row...アセンブリファイルから読み取った現在の行
         self.command...現在のコマンド
     メソッド
-        __init__(str)...アトリビュートの初期化
+        __init__(str or iterable)...アトリビュートの初期化。strならファイル名として開く。それ以外は行のiterable
+        parseAll()...残りの行を全て読み込み、Instructionレコードのリストを返す
         hasMoreCommands()...アセンブリファイルから行を読み込んでself.rowに格納。EOFに達していればFalse
                             EOFではない場合、空白・コメントを除去してブランクにならなければTrue
                             ブランクなら次の行を読み込んでself.rowを更新し、上記処理を繰り返す
@@ -23,6 +24,8 @@ Hackアセンブラ
         dest(str)...destニーモニックの機械語を返す
         comp(str)...compニーモニックの機械語を返す
         jump(str)...jumpニーモニックの機械語を返す
+        instruction(str)...C命令全体のニーモニック（例: "AM=M+1;JGT"）の機械語を16bit整数で返す
+                           結果はself.instructionsにメモ化され、同じニーモニックは辞書引き1回で済む
 
     SymbolTableクラス
     アトリビュート
@@ -37,39 +40,129 @@ Hackアセンブラ
     ・実行ディレクトリを取得しcwdに格納
     ・引数で入力の.asmファイル名を取得。存在確認できなければcwdからの相対パスで探索。見つからなければエラー
     ・出力ファイルは拡張子が.hackになる。cwd下に作成
-    ・1st pass: L命令のラベルをシンボルテーブルに登録；命令のデコードは行わない
-    ・2nd pass: 登録済みのシンボルをアドレスに変換しつつコード生成；A命令のラベルは新規出現時に登録
+    ・デフォルト（1パス）: 入力ファイルを一度だけメモリに読み込み、各行を一度だけInstructionレコードに変換
+        A命令の未定義シンボルは出力位置をfixupsに記録し、L命令でラベルが定義された時点でバックパッチする
+        最後まで定義されなかったシンボルは初出順に変数としてアドレス16から割り当ててバックパッチする
+    ・--cache DIR指定時: ソースのハッシュ（とASSEMBLER_VERSION）をキーにDIR下へ結果をキャッシュ
+        変更の無いファイルは解析もシンボル解決も行わずキャッシュから出力する
+        変更があった場合はラベル定義の行でソースをチャンクに分割し、内容が変わったチャンクだけを再解析する
+    ・asmに"-"を指定した場合（ストリーミング）: 標準入力から読み込み、標準出力に.hack形式で書き出す
+        未解決のシンボル参照が現れるまでは命令をSTREAM_CHUNK個ずつそのまま書き出す
+        以降は命令を32bitのレコード（命令、またはSTREAM_SYMBOL+シンボルID）として一時ファイルにスプールし、
+        EOFでシンボルを解決してからスプールを読み戻して書き出す。メモリに保持するのはシンボルだけ
+    ・--symbols指定時: シンボルファイル（.sym.json）を出力
+        {"predefined": {...}, "labels": {ラベル: ROMアドレス}, "variables": {変数: RAMアドレス}}
+    ・--listing指定時: リスティングファイル（.lst）を出力
+        1行に1命令。"ROMアドレス<TAB>機械語<TAB>ソースの行番号<TAB>ソースの行"
+    ・--optimize指定時: 命令のエンコード前にpeephole()でピープホール最適化を行い、削除した命令数を表示する
+    ・--symbol-free指定時: シンボルフリーの入力として変換（旧AssemblerL.py）。指定が無くても入力にラベルと
+        シンボルが無ければ自動的に同じ高速パスを使う
+    ・--twopass指定時（従来方式）
+        ・1st pass: L命令のラベルをシンボルテーブルに登録；命令のデコードは行わない
+        ・2nd pass: 登録済みのシンボルをアドレスに変換しつつコード生成；A命令のラベルは新規出現時に登録
+
+    AssemblyCacheクラス
+    アトリビュート
+        self.dir...キャッシュディレクトリ
+        self.optimize...ピープホール最適化の有無（キャッシュのキーに含める）
+        self.symbolFree...シンボルフリーモードの指定（キャッシュのキーに含める）
+    メソッド
+        __init__(str, optimize=False, symbolFree=None)...キャッシュディレクトリを作成
+        lookup(str)...ソーステキストに対応するキャッシュがあれば(16bit整数のリスト, シンボルの辞書)を返す。無ければNone
+        store(str, list, SymbolTable)...アセンブル結果を.hackb形式（シンボルテーブル付き）で保存
+        parse(str, list)...前回のチャンク単位の解析結果を再利用してInstructionのリストを返す
+
+    関数
+        parseLine(str)...1行を解析してInstructionレコード（type, value）を返す。ブランクならNone
+                         valueはA命令・L命令ならシンボル、C命令なら空白を除いたニーモニック（例: "AM=M+1;JGT"）
+        isSymbolFree(list)...ラベルが無く、A命令が全て数値ならTrue
+        assembleOnePass(list, SymbolTable, Code, symbolFree=None)...Instructionのリストを1パスで機械語（16bit整数）のリストに変換
+                                                    シンボルフリーの入力（自動判定）ではバックパッチとシンボルテーブルを省略する
+        peephole(list)...Instructionのリストにピープホール最適化を行い、新しいリストを返す
+        assemble(source, st=None, optimize=False)...アセンブリ（テキストまたは行のiterable）を1パスで16bit整数のリストに変換
+        assembleTwoPass(source, st=None)...従来方式（2パス）で16bit整数のリストに変換
+        assembleStream(fin, fout, st=None)...ストリーミングモード。finの行を読みながらfoutに.hack形式で書き出す
+        sourceMap(list)...ソースを走査し(ラベルの集合, ROMアドレスごとの(行番号, ソースの行)のリスト)を返す
+        writeSymbols(str, SymbolTable, set)...シンボルを定義済み・ラベル・変数に分類してJSONで書き出す
+        writeListing(str, list, list)...ROMアドレスとソースの行の対応をリスティングファイルに書き出す
+        writeHack(str, list)...16bit整数のリストをテキスト形式（.hack）で書き出す
+        writeHackb(str, list, SymbolTable=None)...16bit整数のリストをバイナリ形式（.hackb）で書き出す
+        loadHackb(str)...mmapで.hackbを読み込み、(命令のmemoryview, シンボルの辞書)を返す
+        assembleFile(str, ...)....asmファイルをアセンブルして出力ファイルを書き出す。命令数を返す
+                                  cacheDirを指定するとAssemblyCacheを使う
+        findAsmFiles(list)...ディレクトリ以下の.asmファイルを列挙
+        assembleBatch(list, jobs=None, ...)...--batchモード。.asmファイルをProcessPoolExecutorで並列にアセンブルし、
+                                             ファイルごとの所要時間と失敗をサマリ表示。失敗数を返す
+        main(argv=None)...コマンドライン処理。.asmファイルを読み込んで.hackファイルを出力
+
+    バイナリ形式（.hackb）
+        ヘッダ（リトルエンディアン12バイト）: マジック b"HACB", 命令数(uint32), シンボルテーブルのオフセット(uint32, 無ければ0)
+        ヘッダの直後に命令をリトルエンディアンのuint16で命令数分並べる
+        シンボルテーブル（任意）: "シンボル アドレス\n" の行をASCIIで並べたもの。ファイル末尾まで
+
+    ライブラリとしての利用
+        import Assembler
+        words = Assembler.assemble(open("Pong.asm"))  # モジュールのimport時には何も実行されない
 """
 import os
 import re
 import sys
 import argparse
+import collections
+import mmap
+import array
+import struct
+import time
+import pickle
+import hashlib
+import json
+import tempfile
+import concurrent.futures
+
+#
+# Constants
+#
+A_COMMAND = 0
+C_COMMAND = 1
+L_COMMAND = 2
+
+ASSEMBLER_VERSION = "1" # キャッシュのキーに含める。出力が変わる修正をしたら更新すること
+
+HACKB_MAGIC = b"HACB"
+HACKB_HEADER = struct.Struct("<4sII") # magic, word count, symbol table offset
+
+STREAM_CHUNK = 4096 # ストリーミングモードで一度に書き出す命令数
+STREAM_SYMBOL = 1 << 16 # スプールのレコードでこれ以上の値はシンボル参照（STREAM_SYMBOL+シンボルID）
+STREAM_RECORD = "I" if array.array("I").itemsize == 4 else "L" # スプールのレコード型（32bit以上）
 
 #
 # Class definition
 #
 class Parser():
-    def __init__(self, asmFile):
+    def __init__(self, asm):
         # current row
         self.row = ""
         # current command
         self.command = ""
-        # Open .asm file
-        self.asm = open(asmFile, "r")
+        # Open .asm file, or iterate over the lines given in memory
+        if isinstance(asm, str):
+            self.asm = open(asm, "r")
+        else:
+            self.asm = iter(asm)
 
     def hasMoreCommands(self):
         while True:
             # Read one  line
-            line = self.asm.readline()
-            self.row = line
+            line = next(self.asm, None)
             # Return False if EOF appears
-            if not self.row:
+            if line is None:
                 return False
+            self.row = line
             # Remove spaces and comments
             line = line.replace(" ", "")
             line = re.sub(r'//.*', "", line)
             # Return True if line is not blank
-            if line != "\n":
+            if line.strip() != "":
                 return True
             else:
                 continue #If blank, go to next line
@@ -81,6 +174,10 @@ class Parser():
         #
         self.command = line
 
+    def parseAll(self):
+        # 残りの行を読み込み、各行を一度だけInstructionレコードに変換して返す
+        return [inst for inst in map(parseLine, self.asm) if inst]
+
     def commandType(self):
         if self.command.startswith("@"):
             return A_COMMAND
@@ -139,6 +236,12 @@ class Code():
         self.jump_dict = {"null": "000", "JGT": "001", "JEQ": "010",
                           "JGE": "011", "JLT": "100", "JNE": "101",
                           "JLE": "110", "JMP": "111"}
+        # 整数版のテーブル（C命令のビット位置にシフト済み）
+        self.dest_bits = {k: int(v, 2) << 3 for k, v in self.dest_dict.items()}
+        self.comp_bits = {k: int(v, 2) << 6 for k, v in self.comp_dict.items()}
+        self.jump_bits = {k: int(v, 2) for k, v in self.jump_dict.items()}
+        # C命令ニーモニック -> 16bit整数のメモ
+        self.instructions = {}
 
     def dest(self, mnemonic):
         return self.dest_dict[mnemonic]
@@ -149,6 +252,20 @@ class Code():
     def jump(self, mnemonic):
         return self.jump_dict[mnemonic]
 
+    def instruction(self, mnemonic):
+        if mnemonic in self.instructions:
+            return self.instructions[mnemonic]
+        # dest=comp;jump に分解してエンコード
+        dest, eq, rest = mnemonic.partition("=")
+        if not eq:
+            dest, rest = "null", dest
+        comp, sc, jump = rest.partition(";")
+        if not sc:
+            jump = "null"
+        word = 0b111 << 13 | self.comp_bits[comp] | self.dest_bits[dest] | self.jump_bits[jump]
+        self.instructions[mnemonic] = word
+        return word
+
 
 class SymbolTable():
     def __init__(self):
@@ -172,59 +289,272 @@ class SymbolTable():
 
 
 
-################
-# Main program #
-################
-A_COMMAND = 0
-C_COMMAND = 1
-L_COMMAND = 2
+class AssemblyCache():
+    def __init__(self, cacheDir, optimize=False, symbolFree=None):
+        self.dir = cacheDir
+        self.optimize = optimize
+        self.symbolFree = symbolFree
+        os.makedirs(cacheDir, exist_ok=True)
 
-#
-# Corrent directory
-#
-##cwd = os.getcwd()
+    def _digest(self, text):
+        variant = ("O" if self.optimize else "")+("S" if self.symbolFree else "")
+        return hashlib.sha256((ASSEMBLER_VERSION+variant+"\0"+text).encode()).hexdigest()
+
+    def _replace(self, path, write):
+        # 一時ファイルに書いてから置き換える（バッチモードで並列に書き込まれても壊れないように）
+        tmp = path+"."+str(os.getpid())+".tmp"
+        write(tmp)
+        os.replace(tmp, path)
+
+    def lookup(self, text):
+        path = os.path.join(self.dir, self._digest(text)+".hackb")
+        if not os.path.exists(path):
+            return None
+        words, symbols = loadHackb(path)
+        return list(words), symbols
+
+    def store(self, text, hack, st):
+        path = os.path.join(self.dir, self._digest(text)+".hackb")
+        self._replace(path, lambda tmp: writeHackb(tmp, hack, st))
+
+    def parse(self, asmFile, lines):
+        #
+        # ソースをラベル定義の行で区切ったチャンクに分割し、チャンクの内容のハッシュをキーに解析結果を再利用する
+        # チャンクの境界は内容で決まるので、1つの関数を編集しても他のチャンクはヒットする
+        #
+        index = os.path.join(self.dir, "chunks-"+hashlib.sha256(os.path.abspath(asmFile).encode()).hexdigest()+".pickle")
+        try:
+            with open(index, "rb") as fin:
+                previous = pickle.load(fin)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            previous = {}
+        chunks = []
+        start = 0
+        for i, line in enumerate(lines):
+            if i > start and line.lstrip().startswith("("):
+                chunks.append(lines[start:i])
+                start = i
+        chunks.append(lines[start:])
+        current = {}
+        instructions = []
+        for chunk in chunks:
+            digest = hashlib.sha1("\n".join(chunk).encode()).digest()
+            records = current.get(digest)
+            if records is None:
+                records = previous.get(digest)
+            if records is None:
+                # Instructionはタプルとして保存する（pickleがクラスの定義位置に依存しないように）
+                records = [tuple(inst) for inst in map(parseLine, chunk) if inst]
+            current[digest] = records
+            instructions.extend(records)
+        def dump(tmp):
+            with open(tmp, "wb") as fout:
+                pickle.dump(current, fout)
+        self._replace(index, dump)
+        return instructions
 
-#
-# Command argument
-#
-parser = argparse.ArgumentParser(description="Hack Assembler")
-parser.add_argument("asm", type=str, help="Input asm file")
-args = parser.parse_args()
-asmFile = args.asm
 
 #
-# Check input file existence
+# Instruction record
 #
-if not os.path.exists(asmFile):
-    raise FaileNotFoundError("Input .asm file is not found")
+Instruction = collections.namedtuple("Instruction", ["type", "value"])
 
 #
-# 1st pass: make symbol table
+# Code instance shared by assemble() calls; keeps the memo of C instructions warm
 #
-st = SymbolTable()
-parser0 = Parser(asmFile)
-address = 0
-while parser0.hasMoreCommands():
-    # Read next command
-    parser0.advance()
-    # If L_COMMAND, record symbol; if A_ or C_COMMAND, increment address
-    cmdTyp = parser0.commandType()
-    if cmdTyp == L_COMMAND:
-        label = parser0.symbol()
-        if not st.contains(label):
-            st.addEntry(label, address)
-    elif cmdTyp == A_COMMAND or cmdTyp == C_COMMAND:
-        address += 1
+_code = None
 
 #
-# 2nd pass: convert .asm to .hack
+# Function definitions
 #
-parser = Parser(asmFile)
-code = Code()
-binFile = asmFile.replace(".asm", ".hack") #Output file
-user_sym_address = 16  #Address for user-defined labels in A commands
-
-with open(binFile, "w") as hack:
+def parseLine(line):
+    #
+    # 1行を解析してInstructionレコードを返す。空白・コメントのみの行はNone
+    #
+    pos = line.find("//")
+    if pos >= 0:
+        line = line[:pos]
+    command = "".join(line.split())
+    if not command:
+        return None
+    if command[0] == "@":
+        return Instruction(A_COMMAND, command[1:])
+    elif command[0] == "(":
+        return Instruction(L_COMMAND, command[1:-1])
+    # C命令: ニーモニックの分解はCode.instruction()でメモ化して行う
+    return Instruction(C_COMMAND, command)
+
+def isSymbolFree(instructions):
+    #
+    # ラベルが無く、A命令が全て数値ならTrue
+    #
+    for type, value in instructions:
+        if type == L_COMMAND or (type == A_COMMAND and not value.isdecimal()):
+            return False
+    return True
+
+def assembleOnePass(instructions, st, code, symbolFree=None):
+    #
+    # Instructionのリストを1パスで機械語に変換する
+    # 前方参照のシンボルは出力位置をfixupsに記録し、ラベル定義時にバックパッチする
+    # symbolFree ... Trueならシンボル無しとして変換（シンボルがあればValueError）。Noneなら自動判定
+    #
+    memo = code.instructions
+    if symbolFree is None:
+        symbolFree = isSymbolFree(instructions)
+    if symbolFree:
+        #
+        # Fast path: no labels and no symbols; skip back-patching and the symbol table
+        #
+        hack = []
+        for type, value in instructions:
+            if type == C_COMMAND:
+                word = memo.get(value)
+                if word is None:
+                    word = code.instruction(value)
+                hack.append(word)
+            elif type == A_COMMAND:
+                hack.append(int(value))
+            else:
+                raise ValueError("Label ("+value+") is not allowed in symbol-free mode")
+        return hack
+    hack = []
+    fixups = {} # symbol -> 出力位置のリスト（初出順を保持）
+    for type, value in instructions:
+        if type == C_COMMAND:
+            word = memo.get(value)
+            if word is None:
+                word = code.instruction(value)
+            hack.append(word)
+        elif type == A_COMMAND:
+            if value.isdecimal(): # A_COMMAND without symbol
+                hack.append(int(value))
+            elif st.contains(value): # A_COMMAND with symbol that is already registered
+                hack.append(st.getAddress(value))
+            else: # Forward reference or variable; patch later
+                fixups.setdefault(value, []).append(len(hack))
+                hack.append(None)
+        else:
+            if not st.contains(value):
+                st.addEntry(value, len(hack))
+                # Back-patch forward references to this label
+                for pos in fixups.pop(value, []):
+                    hack[pos] = len(hack)
+    # Remaining symbols are variables; allocate from 16 in order of first appearance
+    user_sym_address = 16
+    for label, positions in fixups.items():
+        st.addEntry(label, user_sym_address)
+        for pos in positions:
+            hack[pos] = user_sym_address
+        user_sym_address += 1
+    return hack
+
+def peephole(instructions):
+    #
+    # ピープホール最適化。ラベル（L命令）をまたぐパターンは扱わないので、ジャンプ先は常に正しいまま
+    # ・M=M+1; AM=M-1 -> A=M, M=M+1; M=M-1 -> 削除（逆順も同様）
+    #   例: @SP; M=M+1; @SP; AM=M-1 (push直後のpop) -> @SP; A=M
+    # ・Aレジスタの値が既に同じシンボル/定数の@X -> 削除（Aを書き換えるC命令とラベルで値は不明になる）
+    # ・直後に別のA命令が続くA命令 -> 削除
+    # ・直後のラベルへのジャンプ（@L; 0;JMP; (L)） -> 削除。ラベルの直後がA命令の場合のみ（Aレジスタの値が変わるため）
+    #
+    out = []
+    known = None # Aレジスタに入っているシンボル/定数。不明ならNone
+    for inst in instructions:
+        type, value = inst
+        if type == L_COMMAND:
+            known = None
+        elif type == A_COMMAND:
+            if value == known:
+                continue
+            # Jump to the next instruction: @L; comp;Jxx; (L)...
+            i = len(out)
+            targets = set()
+            while i > 0 and out[i-1][0] == L_COMMAND:
+                targets.add(out[i-1][1])
+                i -= 1
+            if i >= 2 and targets and out[i-1][0] == C_COMMAND and out[i-2][0] == A_COMMAND \
+                    and out[i-2][1] in targets and ";" in out[i-1][1] and "=" not in out[i-1][1]:
+                del out[i-2:i]
+            elif out and out[-1][0] == A_COMMAND:
+                out.pop()
+            known = value
+        else:
+            prev = out[-1][1] if out and out[-1][0] == C_COMMAND else None
+            if (prev, value) in (("M=M+1", "AM=M-1"), ("M=M-1", "AM=M+1")):
+                out[-1] = Instruction(C_COMMAND, "A=M")
+                known = None
+                continue
+            if (prev, value) in (("M=M+1", "M=M-1"), ("M=M-1", "M=M+1")):
+                out.pop()
+                continue
+            if "A" in value.partition("=")[0] and "=" in value:
+                known = None
+        out.append(inst)
+    return out
+
+def _sharedCode():
+    #
+    # assemble()で共有するCodeインスタンスを返す
+    #
+    global _code
+    if _code is None:
+        _code = Code()
+    return _code
+
+def _sourceLines(source):
+    #
+    # strはアセンブリのテキストとみなして行に分割。それ以外は行のiterableとしてそのまま返す
+    #
+    if isinstance(source, str):
+        return source.splitlines()
+    return source
+
+def assemble(source, st=None, optimize=False, symbolFree=None):
+    #
+    # Hackアセンブリを機械語（16bit整数のリスト）に変換する（1パス）
+    # source ... アセンブリのテキスト(str)または行のiterable（ファイルオブジェクトなど）
+    # st ... SymbolTable(optional)。指定するとアセンブル後のシンボルを参照できる
+    # optimize ... Trueならエンコード前にピープホール最適化を行う
+    # symbolFree ... Trueならシンボル無しとして変換（AssemblerL.py相当）。Noneなら自動判定
+    #
+    if st is None:
+        st = SymbolTable()
+    instructions = Parser(_sourceLines(source)).parseAll()
+    if optimize:
+        instructions = peephole(instructions)
+    return assembleOnePass(instructions, st, _sharedCode(), symbolFree)
+
+def assembleTwoPass(source, st=None):
+    #
+    # 従来方式（2パス）で機械語（16bit整数のリスト）に変換する
+    #
+    if st is None:
+        st = SymbolTable()
+    lines = list(_sourceLines(source))
+    #
+    # 1st pass: make symbol table
+    #
+    parser0 = Parser(lines)
+    address = 0
+    while parser0.hasMoreCommands():
+        # Read next command
+        parser0.advance()
+        # If L_COMMAND, record symbol; if A_ or C_COMMAND, increment address
+        cmdTyp = parser0.commandType()
+        if cmdTyp == L_COMMAND:
+            label = parser0.symbol()
+            if not st.contains(label):
+                st.addEntry(label, address)
+        elif cmdTyp == A_COMMAND or cmdTyp == C_COMMAND:
+            address += 1
+    #
+    # 2nd pass: convert .asm to .hack
+    #
+    parser = Parser(lines)
+    code = Code()
+    user_sym_address = 16  #Address for user-defined labels in A commands
+    hack = []
     while parser.hasMoreCommands():
         # Read next command
         parser.advance()
@@ -245,6 +575,335 @@ with open(binFile, "w") as hack:
             instruction = "111"+code.comp(parser.comp())+code.dest(parser.dest())+code.jump(parser.jump())
         elif parser.commandType() == L_COMMAND:
             continue
-        hack.write(instruction+"\n")
+        hack.append(int(instruction, 2))
+    return hack
+
+def assembleStream(fin, fout, st=None):
+    #
+    # finから1行ずつ読み込み、foutに.hack形式で書き出す。書き出した命令数を返す
+    # ソースのテキストは保持しない。前方参照があればそれ以降の命令レコードだけを一時ファイルにスプールする
+    #
+    if st is None:
+        st = SymbolTable()
+    code = _sharedCode()
+    memo = code.instructions
+    symbolIds = {} # 未解決だったシンボル -> シンボルID（初出順）
+    spool = None
+    records = array.array(STREAM_RECORD)
+    out = []
+    address = 0
+    for line in fin:
+        inst = parseLine(line)
+        if inst is None:
+            continue
+        type, value = inst
+        if type == L_COMMAND:
+            if not st.contains(value):
+                st.addEntry(value, address)
+            continue
+        if type == C_COMMAND:
+            word = memo.get(value)
+            if word is None:
+                word = code.instruction(value)
+        elif value.isdecimal(): # A_COMMAND without symbol
+            word = int(value)
+        elif st.contains(value): # A_COMMAND with symbol that is already registered
+            word = st.getAddress(value)
+        else: # Forward reference or variable; resolve at EOF
+            word = STREAM_SYMBOL + symbolIds.setdefault(value, len(symbolIds))
+            if spool is None:
+                spool = tempfile.TemporaryFile()
+        address += 1
+        if spool is None:
+            out.append(format(word, "016b")+"\n")
+            if len(out) >= STREAM_CHUNK:
+                fout.write("".join(out))
+                out.clear()
+        else:
+            records.append(word)
+            if len(records) >= STREAM_CHUNK:
+                records.tofile(spool)
+                del records[:]
+    fout.write("".join(out))
+    if spool is None:
+        return address
+    records.tofile(spool)
+    #
+    # Resolve symbols; labels defined later, otherwise variables from 16 in order of first appearance
+    #
+    user_sym_address = 16
+    resolved = []
+    for symbol in symbolIds:
+        if not st.contains(symbol):
+            st.addEntry(symbol, user_sym_address)
+            user_sym_address += 1
+        resolved.append(st.getAddress(symbol))
+    #
+    # Read back the spool and write out
+    #
+    spool.seek(0)
+    while True:
+        records = array.array(STREAM_RECORD)
+        try:
+            records.fromfile(spool, STREAM_CHUNK)
+        except EOFError: # last (partial) chunk
+            pass
+        if not records:
+            break
+        fout.write("".join(format(resolved[r-STREAM_SYMBOL] if r >= STREAM_SYMBOL else r, "016b")+"\n" for r in records))
+    spool.close()
+    return address
+
+def sourceMap(lines):
+    #
+    # ソースを走査し、(ラベルの集合, ROMアドレスごとの(行番号, ソースの行)のリスト)を返す
+    # 行番号は1始まり
+    #
+    labels = set()
+    rom = []
+    for lineno, line in enumerate(lines, 1):
+        inst = parseLine(line)
+        if inst is None:
+            continue
+        if inst.type == L_COMMAND:
+            labels.add(inst.value)
+        else:
+            rom.append((lineno, line.strip()))
+    return labels, rom
+
+def writeSymbols(symFile, st, labels):
+    #
+    # シンボルを定義済み・ラベル（ROMアドレス）・変数（RAMアドレス）に分類してJSONで書き出す
+    #
+    predefined = SymbolTable().table
+    symbols = {"predefined": {}, "labels": {}, "variables": {}}
+    for symbol, address in st.table.items():
+        if symbol in predefined:
+            symbols["predefined"][symbol] = address
+        elif symbol in labels:
+            symbols["labels"][symbol] = address
+        else:
+            symbols["variables"][symbol] = address
+    with open(symFile, "w") as fout:
+        json.dump(symbols, fout, indent=1)
+        fout.write("\n")
+
+def writeListing(lstFile, hack, rom):
+    #
+    # ROMアドレス, 機械語, ソースの行番号, ソースの行をタブ区切りで1命令1行に書き出す
+    #
+    with open(lstFile, "w") as fout:
+        fout.write("".join("%d\t%s\t%d\t%s\n" % (address, format(word, "016b"), lineno, line)
+                           for address, (word, (lineno, line)) in enumerate(zip(hack, rom))))
+
+def writeHack(binFile, hack):
+    #
+    # 16bit整数のリストをテキスト形式で書き出す
+    #
+    with open(binFile, "w") as fout:
+        fout.write("".join(format(instruction, "016b")+"\n" for instruction in hack))
+
+def writeHackb(binFile, hack, st=None):
+    #
+    # 16bit整数のリストをバイナリ形式（.hackb）で書き出す
+    # stを指定した場合は命令の後ろにシンボルテーブルを付加する
+    #
+    words = array.array("H", hack)
+    if sys.byteorder != "little":
+        words.byteswap()
+    symtab_offset = 0
+    if st is not None:
+        symtab_offset = HACKB_HEADER.size + 2 * len(words)
+    with open(binFile, "wb") as fout:
+        fout.write(HACKB_HEADER.pack(HACKB_MAGIC, len(words), symtab_offset))
+        words.tofile(fout)
+        if st is not None:
+            fout.write("".join(symbol+" "+str(address)+"\n" for symbol, address in st.table.items()).encode("ascii"))
+
+def loadHackb(binFile):
+    #
+    # .hackbをmmapで読み込む。テキストの解析や整数変換は行わない
+    # 戻り値: (命令のmemoryview（'H'）, シンボルの辞書（シンボルテーブルが無ければ空）)
+    #
+    with open(binFile, "rb") as fin:
+        mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, count, symtab_offset = HACKB_HEADER.unpack_from(mm)
+    if magic != HACKB_MAGIC:
+        raise ValueError(binFile+" is not a .hackb file")
+    start = HACKB_HEADER.size
+    words = memoryview(mm)[start:start+2*count]
+    if sys.byteorder == "little":
+        words = words.cast("H")
+    else:
+        words = array.array("H", words)
+        words.byteswap()
+        words = memoryview(words)
+    symbols = {}
+    if symtab_offset:
+        for line in mm[symtab_offset:].decode("ascii").splitlines():
+            symbol, address = line.split()
+            symbols[symbol] = int(address)
+    return words, symbols
+
+def assembleFile(asmFile, twopass=False, binary=False, embedSymbols=False, cacheDir=None,
+                 symbols=False, listing=False, optimize=False, symbolFree=None):
+    #
+    # .asmファイルをアセンブルして出力ファイルを書き出す。命令数を返す
+    #
+    st = SymbolTable()
+    with open(asmFile, "r") as asm:
+        text = asm.read()
+    if cacheDir is None:
+        if twopass:
+            hack = assembleTwoPass(text, st)
+        else:
+            instructions = Parser(text.splitlines()).parseAll()
+    else:
+        cache = AssemblyCache(cacheDir, optimize, symbolFree)
+        hit = cache.lookup(text)
+        if hit is not None: # unchanged source; skip parsing and symbol resolution
+            hack, st.table = hit
+        elif twopass:
+            hack = assembleTwoPass(text, st)
+            cache.store(text, hack, st)
+        else:
+            instructions = cache.parse(asmFile, text.splitlines())
+    if not twopass and (cacheDir is None or hit is None):
+        if optimize:
+            before = len(instructions)
+            instructions = peephole(instructions)
+            print("%s: peephole optimization removed %d instruction(s)" % (asmFile, before-len(instructions)))
+        hack = assembleOnePass(instructions, st, _sharedCode(), symbolFree)
+        if cacheDir is not None:
+            cache.store(text, hack, st)
+    if binary:
+        binFile = asmFile.replace(".asm", ".hackb") #Output file
+        writeHackb(binFile, hack, st if embedSymbols else None)
+    else:
+        binFile = asmFile.replace(".asm", ".hack") #Output file
+        writeHack(binFile, hack)
+    if symbols or listing:
+        labels, rom = sourceMap(text.splitlines())
+        if symbols:
+            writeSymbols(asmFile.replace(".asm", ".sym.json"), st, labels)
+        if listing:
+            writeListing(asmFile.replace(".asm", ".lst"), hack, rom)
+    return len(hack)
+
+def findAsmFiles(dirs):
+    #
+    # ディレクトリ以下（サブディレクトリを含む）の.asmファイルを列挙する
+    #
+    asmFiles = []
+    for d in dirs:
+        if os.path.isfile(d):
+            asmFiles.append(d)
+            continue
+        for root, _, files in os.walk(d):
+            asmFiles.extend(os.path.join(root, f) for f in files if f.endswith(".asm"))
+    return sorted(asmFiles)
+
+def _batchWorker(asmFile, options):
+    #
+    # バッチモードのワーカー（プロセスプール内で実行）
+    # 戻り値: (ファイル名, 所要時間[s], 命令数, エラーメッセージ（成功時None）)
+    #
+    start = time.perf_counter()
+    try:
+        count = assembleFile(asmFile, **options)
+        error = None
+    except Exception as e:
+        count = 0
+        error = type(e).__name__+": "+str(e)
+    return asmFile, time.perf_counter()-start, count, error
+
+def assembleBatch(dirs, jobs=None, **options):
+    #
+    # ディレクトリ以下の.asmファイルをプロセスプールで並列にアセンブルし、結果のサマリを表示する
+    # 失敗したファイルの数を返す
+    #
+    asmFiles = findAsmFiles(dirs)
+    start = time.perf_counter()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_batchWorker, asmFile, options) for asmFile in asmFiles]
+        for future in concurrent.futures.as_completed(futures):
+            results.append(future.result())
+    elapsed = time.perf_counter()-start
+    #
+    # Summary
+    #
+    failed = 0
+    for asmFile, seconds, count, error in sorted(results):
+        if error is None:
+            print("  ok    %8.3fs %6d words  %s" % (seconds, count, asmFile))
+        else:
+            print("  FAIL  %8.3fs               %s: %s" % (seconds, asmFile, error))
+            failed += 1
+    print("Assembled %d file(s), %d failed, in %.3fs" % (len(results)-failed, failed, elapsed))
+    return failed
+
+def main(argv=None):
+    #
+    # Command argument
+    #
+    parser = argparse.ArgumentParser(description="Hack Assembler")
+    parser.add_argument("asm", type=str, nargs="?", help="Input asm file ('-' to stream from stdin to stdout)")
+    parser.add_argument("--twopass", action="store_true", help="Use the original two-pass algorithm")
+    parser.add_argument("--binary", action="store_true", help="Write packed .hackb output instead of .hack text")
+    parser.add_argument("--embed-symbols", action="store_true", help="Append the symbol table to .hackb output")
+    parser.add_argument("--batch", nargs="+", metavar="DIR", help="Assemble every .asm file under DIR(s) in parallel")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes for --batch")
+    parser.add_argument("--cache", metavar="DIR", default=None, help="Reuse results of unchanged sources cached in DIR")
+    parser.add_argument("--symbols", action="store_true", help="Write a .sym.json file of labels, variables and predefined symbols")
+    parser.add_argument("--listing", action="store_true", help="Write a .lst file mapping ROM addresses to source lines")
+    parser.add_argument("--optimize", action="store_true", help="Run the peephole optimizer before encoding")
+    parser.add_argument("--symbol-free", action="store_true", default=None,
+                        help="Treat the input as symbol-free (no labels, numeric @ only); detected automatically otherwise")
+    args = parser.parse_args(argv)
+    if args.optimize and (args.twopass or args.listing):
+        parser.error("--optimize cannot be combined with --twopass or --listing")
+    if args.symbol_free and args.twopass:
+        parser.error("--symbol-free cannot be combined with --twopass")
+    options = {"twopass": args.twopass, "binary": args.binary, "embedSymbols": args.embed_symbols,
+               "cacheDir": args.cache, "symbols": args.symbols, "listing": args.listing,
+               "optimize": args.optimize, "symbolFree": args.symbol_free}
+
+    #
+    # Batch mode
+    #
+    if args.batch:
+        if assembleBatch(args.batch, args.jobs, **options):
+            sys.exit(1)
+        return
+    if args.asm is None:
+        parser.error("the following arguments are required: asm")
+    asmFile = args.asm
+
+    #
+    # Streaming mode: stdin -> stdout
+    #
+    if asmFile == "-":
+        if args.binary or args.twopass or args.cache or args.symbols or args.listing or args.optimize or args.symbol_free:
+            parser.error("--binary, --twopass, --cache, --symbols, --listing, --optimize and --symbol-free "
+                         "cannot be used when streaming from stdin")
+        assembleStream(sys.stdin, sys.stdout)
+        return
+
+    #
+    # Check input file existence
+    #
+    if not os.path.exists(asmFile):
+        raise FileNotFoundError("Input .asm file is not found")
+
+    #
+    # Convert .asm to .hack
+    #
+    assembleFile(asmFile, **options)
 
 
+################
+# Main program #
+################
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Assembler
+
+
+class AssembleStreamTest(unittest.TestCase):
+    def _stream(self, source):
+        fout = io.StringIO()
+        count = Assembler.assembleStream(io.StringIO(source), fout)
+        return count, [int(line, 2) for line in fout.getvalue().splitlines()]
+
+    def test_forward_labels_and_variables(self):
+        source = "@2\nD=A\n@LOOP\n0;JMP\n@i\nM=D\n(LOOP)\n@j\nM=0\n@LOOP\n0;JMP\n"
+        count, words = self._stream(source)
+        self.assertEqual(words, Assembler.assemble(source))
+        self.assertEqual(count, len(words))
+
+    def test_more_than_65536_forward_symbols(self):
+        # シンボルIDが16bitを超えても取り違えないこと
+        n = 70000
+        lines = ["@L%d" % i for i in range(n)]
+        for i in range(n):
+            lines += ["(L%d)" % i, "D=0"]
+        source = "\n".join(lines)+"\n"
+        count, words = self._stream(source)
+        expected = Assembler.assemble(source)
+        # 不一致の位置だけを報告する（大きなリストの差分表示は遅い）
+        mismatch = next((i for i, (a, b) in enumerate(zip(words, expected)) if a != b), None)
+        self.assertIsNone(mismatch)
+        self.assertEqual(len(words), len(expected))
+        self.assertEqual(count, 2*n)
+
+
+class AssemblyCacheTest(unittest.TestCase):
+    def test_symbol_free_is_part_of_the_key(self):
+        # シンボルありで作ったキャッシュを--symbol-freeの実行で使わないこと
+        with tempfile.TemporaryDirectory() as tmp:
+            asmFile = os.path.join(tmp, "Loop.asm")
+            with open(asmFile, "w") as fout:
+                fout.write("(LOOP)\n@LOOP\n0;JMP\n")
+            cacheDir = os.path.join(tmp, "cache")
+            Assembler.assembleFile(asmFile, cacheDir=cacheDir)
+            with self.assertRaises(ValueError):
+                Assembler.assembleFile(asmFile, cacheDir=cacheDir, symbolFree=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
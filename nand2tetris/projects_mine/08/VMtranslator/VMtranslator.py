@@ -1,51 +1,111 @@
-import os
-import sys
-import re
-import glob
-import argparse
-
 """
 バーチャルマシン(VM)プログラムをHackアセンブリに変換する（#2: 完全版）
-Usage: $ python VMtranslator.py <prog_dir>
+Usage: $ python VMtranslator.py <prog_dir> [--jobs N] [--hack]
 * prog_dirは.vmファイル群が置かれたディレクトリパス
-* 出力：prog_dirディレクトリ下にprog_dir.asmが生成される
+* 出力：prog_dirディレクトリ下にprog_dir.asmが生成される（--hackの場合はprog_dir.hack）
 
 Parserクラス
 * アトリビュート
 ** self.vm ... .vmファイルのデスクリプタ
 ** self.row ... 現在読み込んでいる行
 ** self.command ... 現在読み込んでいるコマンド
+** self.record ... 現在のコマンドを分割したVMCommandレコード
 * __init__() ... アドリビュートを初期化
 * hasMoreCommands() ... self.vmから1行読んでEOFならFalse. コメント削除&strip()してブランクにならなければTrue.
                          ブランクなら次の行を読み込んで繰り返し。Trueの時は読み込んだ行をself.rowに格納
-* advance() ... self.rowかのコメントを除去しstrip()　→self.commandに格納
-* commandType(str) ... コマンド(str)の種類を返す
+* advance() ... self.rowかのコメントを除去しstrip()　→self.commandに格納し、parseCommand()でself.recordを作る
+* commandType(str) ... コマンドの種類を返す（self.record.type）
 * arg1() ... コマンドの第1引数を返す。C_ARITHMETICの場合はコマンド自身を返す
-* arg2() ... コマンドの第2引数を返す
+* arg2() ... コマンドの第2引数をintで返す
+* parseAll() ... 残りの行を全て読み込み、VMCommandのリストを返す
 
 CodeWriterクラス
 * アトリビュート
 ** self.asm ... 出力ファイルのデスクリプタ
 ** self.vm ... 現在読み込まれている.vmファイル名
-** self.label_id ... .asmのL_COMMANDに使うラベルの通し番号。開始は1
+** self.label_id ... .asmのL_COMMANDに使うラベルの通し番号。開始は1。.vmファイルごとに振り直す
 ** self.func_name ... 現在の関数名（初期値は"null"）
 ** self.ln ... ROMアドレス（コメントと擬コードを除いた行番号；0開始）。※デバッグ用途のみ
-* __init__() ... アトリビュートの初期化
-* _getLabel() ... self.label_idからユニークなラベル文字列を生成して返す。self.label_idをインクリメントする
-* _outCommand(str) ... str型の引数にROMアドレスself.lnと改行コードをつけて返し、ROMアドレスをインクリメント
+** self.buffer ... 出力する行のバッファ。BUFFER_LINES行以上たまるとまとめて書き込む
+** self.rom_comments ... 各命令の後ろにROMアドレスのコメント（// <rom address>）を付けるか（--no-rom-commentsでFalse）
+* __init__() ... アトリビュートの初期化。出力先はファイルパスまたはファイルオブジェクト
+* _getLabel() ... .vmファイル名とself.label_idからファイル内でユニークなラベル文字列を生成して返す。self.label_idをインクリメントする
+* _outCommand(str) ... str型の引数にROMアドレスself.lnと改行コードをつけてバッファに追加し、ROMアドレスをインクリメント
+* _outLabel(str), _outComment(str), _outDetail(str) ... ラベル擬コマンド、コメント、call処理の内訳コメント（//+++）をバッファに追加
+* _writeBuffer(force=False) ... バッファがBUFFER_LINES行以上（forceがTrueなら常に）のとき出力ファイルにまとめて書き込む
 * setFileName(str) ... self.vmを設定
 * writeInit() ... ブートストラップコードを書き込む。SP=256に初期化し、Sys.initをcall（writeCall("Sys.init", 0)を実行）
+* writeXxx() ... 各コマンドの命令列はバッファに追加され、出力ファイルへの書き込みは_writeBuffer()でまとめて行う
 * writeArithmetic(str) ... 9種類のarithmeticコマンドをHackアセンブリに変換して出力ファイルに書き込む
 * writePushPop(str1, str2, int) ... push, popコマンドをHackアセンブリに変換して出力ファイルに書き込む
+** pointer, temp, staticとindexがSMALL_INDEX以下のlocal, argument, this, thatはR13を使わずに直接書き込む
+* _isDirect(str, int) ... セグメントのアドレスをDレジスタを使わずにAレジスタに求められるか
+* _segmentAddress(str, int) ... 定数アドレスまたはベースポインタ+A=A+1の繰り返しでアドレスをAレジスタに求める命令列を出力
+* _loadValue(str, int) ... セグメントの値をDレジスタに読み込む命令列を出力
+* _storeD(str, int) ... Dレジスタの値をセグメントに書き込む命令列を出力
+* _pushD() ... Dレジスタの値をpushする命令列を出力
 * writeLabel(str) ... labelコマンドを変換して出力ファイルに書き込む
 * writeGoto(str) ... gotoコマンドを変換して出力ファイルに書き込む
 * writeIf(str) ... if-gotoコマンドを変換して出力ファイルに書き込む
 * writeCall(str, int) ... callコマンドを変換して出力ファイルに書き込む
 * writeReturn() ... returnコマンドを変換して出力ファイルに書き込む
 * writeFunction(str, int) ... functionコマンドを変換して出力ファイルに書き込む
+* shared_call=Trueの場合（--shared-call）
+** writeInit()でSys.initの呼び出しの後に停止ループ、共有callルーチン($CALL)、共有returnルーチン($RETURN)を書き込む
+** writeCall()はR13=関数のアドレス, R14=引数の数, R15=return addressを設定して$CALLにジャンプするだけ
+** writeReturn()は$RETURNにジャンプするだけ
+* shared_compare=Trueの場合（--shared-compare）
+** writeInit()でeq, gt, ltの共有比較ルーチン($EQ, $GT, $LT)を書き込む
+** writeArithmetic()のeq, gt, ltはR15=return addressを設定して共有比較ルーチンにジャンプするだけ
+* cache_tos=Trueの場合（--cache-tos）
+** self.tos_in_d ... スタックトップの値をスタックに書き込まずDレジスタに保持しているか。このときSPはその値の格納先を指す
+** _flushTOS() ... Dレジスタのスタックトップをスタックに書き戻す。label, goto, call, return, functionの前とファイルの切り替わり・終了時に実行
+** _popToD() ... スタックトップをDレジスタにpopする。キャッシュされていれば命令を出力しない
+** push, 算術演算, 比較の結果はDレジスタに残し、直後のpop, 算術演算, if-gotoはDレジスタから直接使う
 ** R[13]-R[15]の領域は汎用レジスタとしてpopコマンドの変換で使用
-* close() ... 出力ファイルをクローズ
+* writeMove((str, int), (str, int)) ... push src; pop dstをスタックを経由せずに変換して出力ファイルに書き込む
+* fragment() ... 出力ファイルに書き込まずに変換結果をリンク用の断片(アセンブリ, 命令数)として返す
+* appendFragment(tuple) ... 断片を連結する。ROMアドレスのコメントは連結位置に合わせて振り直す
+* mark() ... 断片の現在の位置を返す
+* truncate(tuple) ... mark()の位置より後ろの出力を取り消し、取り消した命令数を返す（--eliminate-deadで関数を取り除く）
+* close() ... バッファの残りを書き込んで出力ファイルをクローズ（ファイルオブジェクトを渡された場合はクローズしない）
+
+HackWriterクラス（CodeWriterのサブクラス; --hack）
+* アセンブリのテキストを経由せずにHackの機械語を出力する
+* _outCommand(), _outLabel() ... アセンブラ(06/Assembler/Assembler.py)のInstructionレコードをバッファに追加。コメントは出力しない
+* fragment(), appendFragment() ... 断片はInstructionレコードのリスト。ラベルはシンボルのままなので振り直しは不要
+* close() ... Assembler.assembleOnePass()でラベルと変数を解決し、.hackファイルに書き込む
+* アセンブラは_importAssembler()でHackWriterの生成時に初めてimportする（--hackを使わなければ06は不要）
+
+VM中間表現（IR）と最適化（--optimize）
+* VMCommand ... コマンドのレコード(type, arg1, arg2)。arg2はint。C_MOVEのarg1, arg2は(segment, index)
+* parseCommand(str) ... 1行のコマンドを分割してVMCommandを返す
+* parseFile(str) ... .vmファイルの全コマンドをVMCommandのリストとして読み込む
+* splitFunctions(list) ... コマンド列をfunctionごとのブロックに分割する
+* foldConstants(list) ... push constant a; push constant b; add などを push constant (a+b) に畳み込む。負数の結果は push constant (~結果); not
+* removeDeadCode(list) ... goto, returnの後ろで次のlabel, functionまでの到達しないコマンドを削除
+* fusePushPop(list) ... push x; pop x を削除し、push x; pop y を move (C_MOVE) に融合する
+* optimize(list) ... 関数ブロックごとにOPTIMIZATION_PASSESを順に適用する
+* callGraph(list) ... 関数名 -> callする関数名の集合 の呼び出しグラフを作る
+* reachableFunctions(dict, root="Sys.init") ... rootから到達できる関数名の集合を返す
+* writeCommands(CodeWriter, list) ... VMCommandのリストをCodeWriterで変換する
+
+ファイル単位の変換とリンク
+* translateFile(str, bool, bool, set, list, **options) ... 1つの.vmファイルを独立した断片に変換し、(断片, 取り除いた関数の命令数)を返す
+** 到達できない関数も一度だけ変換してその命令数を数え、断片からはtruncate()で取り除く
+* link(CodeWriter, list) ... ブートストラップの後ろに断片を連結する
+* translate(str, jobs=1, ...) ... prog_dir下の.vmファイルをファイル名順に変換してリンクする。jobsが1でなければプロセスプールで並列に変換
+                                  eliminate_dead=Trueなら全ファイルの呼び出しグラフからSys.initに到達できない関数を除き、削減量を表示
+                                  このとき各.vmファイルは呼び出しグラフ用に一度だけ解析し、そのコマンド列をtranslateFile()に渡す
+* main(argv=None) ... コマンドライン処理。モジュールのimport時には何も実行されない
 """
+import os
+import sys
+import re
+import glob
+import argparse
+import concurrent.futures
+from collections import namedtuple
 
 #
 # Constants
@@ -59,6 +119,45 @@ C_IF = 5
 C_FUNCTION = 6
 C_RETURN = 7
 C_CALL = 8
+C_MOVE = 9 # 最適化で生成される push+pop の融合コマンド
+
+#
+# VMコマンドのレコードとコマンド名からの変換表
+#
+VMCommand = namedtuple("VMCommand", ["type", "arg1", "arg2"])
+COMMAND_TYPES = {"add": C_ARITHMETIC, "sub": C_ARITHMETIC, "neg": C_ARITHMETIC,
+                 "eq": C_ARITHMETIC, "gt": C_ARITHMETIC, "lt": C_ARITHMETIC,
+                 "and": C_ARITHMETIC, "or": C_ARITHMETIC, "not": C_ARITHMETIC,
+                 "push": C_PUSH, "pop": C_POP, "label": C_LABEL, "goto": C_GOTO, "if-goto": C_IF,
+                 "function": C_FUNCTION, "call": C_CALL, "return": C_RETURN}
+
+#
+# 06のアセンブラ（--hack）
+#
+ASSEMBLER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "06", "Assembler")
+
+#
+# Shared routines (--shared-call)
+#
+CALL_ROUTINE = "$CALL"
+RETURN_ROUTINE = "$RETURN"
+HALT_LABEL = "$HALT"
+
+#
+# Segment addressing (push/pop, move)
+#
+SMALL_INDEX = 7 # これ以下のindexはR13を使わずA=A+1の繰り返しでアドレスを求める
+SEGMENT_BASE = {"local": "@LCL", "argument": "@ARG", "this": "@THIS", "that": "@THAT"}
+
+#
+# Shared comparison routines (--shared-compare)
+#
+COMPARE_ROUTINES = {"eq": ("$EQ", "JEQ"), "gt": ("$GT", "JGT"), "lt": ("$LT", "JLT")}
+
+#
+# Output buffering (CodeWriter)
+#
+BUFFER_LINES = 8192 # CodeWriterがまとめて書き込む行数
 
 #
 # Class definitions
@@ -68,6 +167,7 @@ class Parser():
         self.vm = open(infile, "r")
         self.row = ""
         self.command = ""
+        self.record = None
         print("Open VM file", infile)
 
     def hasMoreCommands(self):
@@ -76,7 +176,7 @@ class Parser():
             if not line:
                 return False
             else:
-                tmp = re.sub(r'//.*', "", line).strip()
+                tmp = line.split("//", 1)[0].strip()
                 if tmp != "":
                     self.row = line
                     return True
@@ -84,400 +184,1061 @@ class Parser():
                     continue
 
     def advance(self):
-        self.command = re.sub(r'//.*', "", self.row).strip()
+        self.command = self.row.split("//", 1)[0].strip()
+        self.record = parseCommand(self.command)
 
     def commandType(self):
-        token = self.command.split()
-        if len(token) > 0:
-            cmd = self.command.split()[0].lower()
-        else:
-            cmd = self.command.lower()
-        if cmd in ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]:
-            return C_ARITHMETIC
-        elif cmd == "push":
-            return C_PUSH
-        elif cmd == "pop":
-            return C_POP
-        elif cmd == "label":
-            return C_LABEL
-        elif cmd == "goto":
-            return C_GOTO
-        elif cmd == "if-goto":
-            return C_IF
-        elif cmd == "function":
-            return C_FUNCTION
-        elif cmd == "call":
-            return C_CALL
-        elif cmd == "return":
-            return C_RETURN
+        return self.record.type
 
     def arg1(self):
-        args = self.command.split()
-        if self.commandType() == C_ARITHMETIC:
-            return args[0]
-        else:
-            return args[1]
+        return self.record.arg1
 
     def arg2(self):
-        return int(self.command.split()[2])
+        return self.record.arg2
+
+    def parseAll(self):
+        # 残りの行を全て読み込み、VMCommandのリストを返す
+        commands = []
+        for line in self.vm:
+            command = line.split("//", 1)[0]
+            if command and not command.isspace():
+                commands.append(parseCommand(command))
+        self.vm.close()
+        return commands
 
 
 class CodeWriter():
-    def __init__(self, outfile):
-        self.asm = open(outfile, "w")
+    def __init__(self, outfile, shared_call=False, shared_compare=False, cache_tos=False, rom_comments=True):
+        # outfileはファイルパス、書き込み可能なファイルオブジェクト、またはNone（fragment()で結果を取り出す場合）
+        self.own_file = isinstance(outfile, str)
+        self.asm = open(outfile, "w") if self.own_file else outfile
         self.vm_name = ""
         self.label_id = 0
         self.func_name = "null"
         self.ln = 0
+        self.buffer = []
+        self.rom_comments = rom_comments
+        self.shared_call = shared_call
+        self.shared_compare = shared_compare
+        self.cache_tos = cache_tos
+        self.tos_in_d = False
 
     def _outCommand(self, cmd):
-        # cmd文字列にアドレスと改行を付け加えて返す
-        cmd_line = cmd + " // " + str(self.ln) + "\n"
+        # cmd文字列に改行（rom_commentsがTrueならROMアドレスのコメントも）を付け加えてバッファに追加
+        if self.rom_comments:
+            self.buffer.append(cmd + " // " + str(self.ln) + "\n")
+        else:
+            self.buffer.append(cmd + "\n")
         self.ln += 1
-        return cmd_line
+
+    def _outLabel(self, label):
+        # ラベル擬コマンドをバッファに追加（ROMアドレスは進めない）
+        self.buffer.append("(" + label + ")\n")
+
+    def _outComment(self, comment):
+        # VMコマンドのコメントをバッファに追加
+        self.buffer.append("// " + comment + "\n")
+
+    def _outDetail(self, comment):
+        # call処理の内訳のコメントをバッファに追加
+        self.buffer.append("//+++ " + comment + "\n")
+
+    def _writeBuffer(self, force=False):
+        # バッファがBUFFER_LINES行以上たまったら（forceがTrueなら常に）まとめて出力ファイルに書き込む
+        if self.asm is not None and (force or len(self.buffer) >= BUFFER_LINES):
+            self.asm.write("".join(self.buffer))
+            self.buffer.clear()
 
     def _genLabel(self):
         # 汎用のユニークラベルを返す
+        # .vmファイルごとに独立に変換できるよう、ラベルにはファイル名を付けて通し番号はファイルごとに振る
         self.label_id += 1
-        return "label_uniq_"+str(self.label_id)
+        return self.vm_name+"$label_uniq_"+str(self.label_id)
+
+    def _flushTOS(self):
+        # Dレジスタにキャッシュしているスタックトップをスタックに書き戻す
+        if not self.tos_in_d:
+            return
+        self.tos_in_d = False
+        self._outCommand("@SP")
+        self._outCommand("M=M+1")
+        self._outCommand("A=M-1")
+        self._outCommand("M=D")
+
+    def _popToD(self):
+        # スタックトップをDレジスタにpopする。キャッシュしていれば何もしない
+        if self.tos_in_d:
+            self.tos_in_d = False
+            return
+        self._outCommand("@SP")
+        self._outCommand("AM=M-1")
+        self._outCommand("D=M")
 
     def setFileName(self, filename):
         # .vmファイル名を設定
+        self._flushTOS()
         self.vm_name = os.path.basename(filename).replace(".vm", "")
+        self.label_id = 0
 
     def writeInit(self):
         # スタックポインタ初期化; SP=256
-        out = self._outCommand("@256")
-        out += self._outCommand("D=A")
-        out += self._outCommand("@SP")
-        out += self._outCommand("M=D")
-        self.asm.write(out)
+        self._outCommand("@256")
+        self._outCommand("D=A")
+        self._outCommand("@SP")
+        self._outCommand("M=D")
+        self._writeBuffer()
         # call Sys.init
         self.vm_name = "Sys.vm"
         self.writeCall("Sys.init", 0)
+        if self.shared_call or self.shared_compare:
+            # Sys.initは戻らないが、念のため共有ルーチンに落ちないよう停止ループを置く
+            self._outLabel(HALT_LABEL)
+            self._outCommand("@"+HALT_LABEL)
+            self._outCommand("0;JMP")
+            self._writeBuffer()
+        if self.shared_call:
+            self._writeCallRoutine()
+            self._writeReturnRoutine()
+        if self.shared_compare:
+            for command in ["eq", "gt", "lt"]:
+                self._writeCompareRoutine(command)
+
+    def _writeCompareRoutine(self, command):
+        # 共有比較ルーチン。R15=return address
+        routine, jump = COMPARE_ROUTINES[command]
+        self._outComment("shared "+command+" routine")
+        self._outLabel(routine)
+        # yをpopしてx-yを計算
+        self._outCommand("@SP")
+        self._outCommand("AM=M-1")
+        self._outCommand("D=M")  # D = value of y
+        self._outCommand("A=A-1")  # A = address of x
+        self._outCommand("D=M-D")
+        # xのアドレスにTrueを書き込み、条件が成立しなければFalseで上書き
+        self._outCommand("M=-1")
+        self._outCommand("@"+routine+"$TRUE")
+        self._outCommand("D;"+jump)
+        self._outCommand("@SP")
+        self._outCommand("A=M-1")  # A = address of x
+        self._outCommand("M=0")
+        self._outLabel(routine+"$TRUE")
+        # return
+        self._outCommand("@R15")
+        self._outCommand("A=M")
+        self._outCommand("0;JMP")
+        self._writeBuffer()
+
+    def _writeCallRoutine(self):
+        # 共有callルーチン。R13=呼び出す関数のアドレス, R14=引数の数, R15=return address
+        self._outComment("shared call routine")
+        self._outLabel(CALL_ROUTINE)
+        ## return address(R15), LCL, ARG, THIS, THATをpushする
+        for label in ["R15", "LCL", "ARG", "THIS", "THAT"]:
+            self._outDetail("push "+label)
+            self._outCommand("@"+label)
+            self._outCommand("D=M")
+            self._outCommand("@SP")
+            self._outCommand("A=M")
+            self._outCommand("M=D")
+            self._outCommand("@SP")
+            self._outCommand("M=M+1")
+        # ARG = SP-R14-5
+        self._outDetail("ARG = SP-R14-5")
+        self._outCommand("@R14")
+        self._outCommand("D=M")
+        self._outCommand("@5")
+        self._outCommand("D=D+A") #D=5+narg
+        self._outCommand("@SP")
+        self._outCommand("D=M-D")
+        self._outCommand("@ARG")
+        self._outCommand("M=D")
+        # LCL = SP
+        self._outDetail("LCL=SP")
+        self._outCommand("@SP")
+        self._outCommand("D=M")
+        self._outCommand("@LCL")
+        self._outCommand("M=D")
+        # goto R13
+        self._outDetail("goto R13")
+        self._outCommand("@R13")
+        self._outCommand("A=M")
+        self._outCommand("0;JMP")
+        self._writeBuffer()
+
+    def _writeReturnRoutine(self):
+        # 共有returnルーチン
+        self._outComment("shared return routine")
+        self._outLabel(RETURN_ROUTINE)
+        self._returnBody()
+        self._writeBuffer()
 
     def writeArithmetic(self, command):
-        out = "// "+command+"\n"
+        if self.cache_tos:
+            self._writeArithmeticTOS(command)
+            return
+        self._outComment(command)
         if command in ["add", "sub", "and", "or"]: # 2 operands
             # M[M[SP]-1]（yの値）をDレジスタに保存
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M-1") # M[SP]-1
-            out += self._outCommand("D=M")  # D = value of y
+            self._outCommand("@SP")
+            self._outCommand("A=M-1") # M[SP]-1
+            self._outCommand("D=M")  # D = value of y
             # M[SP]-2（xのアドレス）をAレジスタに保存
-            out += self._outCommand("A=A-1") # A = address of x
+            self._outCommand("A=A-1") # A = address of x
             # 演算を実行し、結果をM[M[SP]-2]（xのアドレス）に保存
             if command == "add":
-                out += self._outCommand("M=D+M")
+                self._outCommand("M=D+M")
             elif command == "sub":
-                out += self._outCommand("M=M-D")
+                self._outCommand("M=M-D")
             elif command == "and":
-                out += self._outCommand("M=D&M")
+                self._outCommand("M=D&M")
             elif command == "or":
-                out += self._outCommand("M=D|M")
+                self._outCommand("M=D|M")
             # スタックポインタを1減らす
-            out += self._outCommand("@SP")
-            out += self._outCommand("M=M-1") # Update stack pointer
+            self._outCommand("@SP")
+            self._outCommand("M=M-1") # Update stack pointer
+        elif command in ["eq", "gt", "lt"] and self.shared_compare:
+            # R15=return addressとして共有比較ルーチンにジャンプ
+            rt = self._genLabel()
+            self._outCommand("@"+rt)
+            self._outCommand("D=A")
+            self._outCommand("@R15")
+            self._outCommand("M=D")
+            self._outCommand("@"+COMPARE_ROUTINES[command][0])
+            self._outCommand("0;JMP")
+            self._outLabel(rt)
         elif command in ["eq", "gt", "lt"]: # 2 operands and boolian return value
             # M[M[SP]-1]（yの値）をDレジスタに保存
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M-1")  # M[SP]-1
-            out += self._outCommand("D=M")  # D = value of y
+            self._outCommand("@SP")
+            self._outCommand("A=M-1")  # M[SP]-1
+            self._outCommand("D=M")  # D = value of y
             # M[SP]-2（xのアドレス）をAレジスタに保存
-            out += self._outCommand("A=A-1")  # A = address of x
+            self._outCommand("A=A-1")  # A = address of x
             # x-yをDレジスタに保存
-            out += self._outCommand("D=M-D")
+            self._outCommand("D=M-D")
             # 条件成立時のジャンプ先のユニークラベルを作成
             label1 = self._genLabel()
-            out += self._outCommand("@"+label1)
+            self._outCommand("@"+label1)
             if command == "eq":
-                out += self._outCommand("D;JEQ")
+                self._outCommand("D;JEQ")
             elif command == "gt":
-                out += self._outCommand("D;JGT")
+                self._outCommand("D;JGT")
             elif command == "lt":
-                out += self._outCommand("D;JLT")
+                self._outCommand("D;JLT")
             # xのアドレスにFalseを書き込んだあとlabel2にジャンプ
-            out += self._outCommand("@2")
-            out += self._outCommand("D=A")
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M-D") # A = address of x
-            out += self._outCommand("M=0")
+            self._outCommand("@2")
+            self._outCommand("D=A")
+            self._outCommand("@SP")
+            self._outCommand("A=M-D") # A = address of x
+            self._outCommand("M=0")
             label2 = self._genLabel()
-            out += self._outCommand("@"+label2)
-            out += self._outCommand("0;JMP")
-            out += "("+label1+")\n"
+            self._outCommand("@"+label2)
+            self._outCommand("0;JMP")
+            self._outLabel(label1)
             # xのアドレスにTrueを書き込む
-            out += self._outCommand("@2")
-            out += self._outCommand("D=A")
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M-D")  # A = address of x
-            out += self._outCommand("M=-1")
-            out += "("+label2+")\n"
+            self._outCommand("@2")
+            self._outCommand("D=A")
+            self._outCommand("@SP")
+            self._outCommand("A=M-D")  # A = address of x
+            self._outCommand("M=-1")
+            self._outLabel(label2)
             # スタックポインタを1減らす
-            out += self._outCommand("@SP")
-            out += self._outCommand("M=M-1")
+            self._outCommand("@SP")
+            self._outCommand("M=M-1")
         else: # 1 operand (neg or not)
             # オペランドのアドレスをAレジスタに保存
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M-1")  # A = address of y
+            self._outCommand("@SP")
+            self._outCommand("A=M-1")  # A = address of y
             # 演算結果をオペランドのアドレスに書き込む
             if command == "neg":
-                out += self._outCommand("M=-M")
+                self._outCommand("M=-M")
             elif command == "not":
-                out += self._outCommand("M=!M")
-        self.asm.write(out)
+                self._outCommand("M=!M")
+        self._writeBuffer()
+
+    def _writeArithmeticTOS(self, command):
+        # スタックトップキャッシュ版。演算結果はDレジスタに残す
+        self._outComment(command)
+        if command in ["add", "sub", "and", "or"]: # 2 operands
+            self._popToD() # D = value of y
+            self._outCommand("@SP")
+            self._outCommand("AM=M-1") # pop x; A = address of x
+            if command == "add":
+                self._outCommand("D=D+M")
+            elif command == "sub":
+                self._outCommand("D=M-D")
+            elif command == "and":
+                self._outCommand("D=D&M")
+            elif command == "or":
+                self._outCommand("D=D|M")
+            self.tos_in_d = True
+        elif command in ["eq", "gt", "lt"] and self.shared_compare:
+            # 共有比較ルーチンはスタック上で演算するので書き戻してから呼ぶ
+            self._flushTOS()
+            self.cache_tos = False
+            self.writeArithmetic(command)
+            self.cache_tos = True
+            return
+        elif command in ["eq", "gt", "lt"]:
+            self._popToD() # D = value of y
+            self._outCommand("@SP")
+            self._outCommand("AM=M-1") # pop x
+            self._outCommand("D=M-D") # D = x-y
+            label1 = self._genLabel()
+            self._outCommand("@"+label1)
+            self._outCommand("D;"+COMPARE_ROUTINES[command][1])
+            self._outCommand("D=0") # False
+            label2 = self._genLabel()
+            self._outCommand("@"+label2)
+            self._outCommand("0;JMP")
+            self._outLabel(label1)
+            self._outCommand("D=-1") # True
+            self._outLabel(label2)
+            self.tos_in_d = True
+        else: # 1 operand (neg or not)
+            if self.tos_in_d:
+                if command == "neg":
+                    self._outCommand("D=-D")
+                elif command == "not":
+                    self._outCommand("D=!D")
+            else:
+                self._outCommand("@SP")
+                self._outCommand("A=M-1")  # A = address of y
+                if command == "neg":
+                    self._outCommand("M=-M")
+                elif command == "not":
+                    self._outCommand("M=!M")
+        self._writeBuffer()
+
+    def _writePushPopTOS(self, command, segment, index):
+        # スタックトップキャッシュ版。pushした値はDレジスタに残す
+        self._outComment(command+" "+segment+" "+str(index))
+        if command == "push":
+            self._flushTOS()
+            self._loadValue(segment, index)
+            self.tos_in_d = True
+        elif command == "pop":
+            if segment == "constant":
+                raise ValueError("Invalid memory segment.")
+            self._popToD()
+            self._storeD(segment, index)
+        self._writeBuffer()
 
     def writePushPop(self, command, segment, index):
-        out = "// "+command+" "+segment+" "+str(index)+"\n"
-        if segment == "constant":
+        if self.cache_tos:
+            self._writePushPopTOS(command, segment, index)
+            return
+        self._outComment(command+" "+segment+" "+str(index))
+        if command == "push" and segment != "constant" and self._isDirect(segment, index) and \
+           (segment not in SEGMENT_BASE or index <= 1):
+            # アドレスをAレジスタに直接求めて値を読み込み、push
+            self._segmentAddress(segment, index)
+            self._outCommand("D=M")
+            self._pushD()
+        elif command == "pop" and self._isDirect(segment, index):
+            # スタックからDレジスタにpopし、R13を経由せずに書き込む
+            self._outCommand("@SP")
+            self._outCommand("AM=M-1")
+            self._outCommand("D=M")
+            self._segmentAddress(segment, index)
+            self._outCommand("M=D")
+        elif segment == "constant":
             # indexをDレジスタに読み込む
-            out += self._outCommand("@"+str(index))
-            out += self._outCommand("D=A") # D = index
-            # スタックポインタの位置にDレジスタの値を書き込む。pushのみ（pop constantは存在しない）
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M") # A is stack pointer
-            out += self._outCommand("M=D") # push index
-            # スタックポインタを1増やす
-            out += self._outCommand("@SP")
-            out += self._outCommand("M=M+1")
+            self._outCommand("@"+str(index))
+            self._outCommand("D=A") # D = index
+            # スタックポインタを1増やし、その直前の位置にDレジスタの値を書き込む。pushのみ（pop constantは存在しない）
+            self._pushD()
         elif segment in ["local", "argument", "this", "that", "pointer", "temp", "static"]:
             # アドレス解決; 読み込みまたは書き込み先のRAMアドレスをAレジスタに格納
             ## 該当するベースポインタの値をDに読み込む
             if segment == "local":
-                out += self._outCommand("@LCL")
-                out += self._outCommand("D=M")
+                self._outCommand("@LCL")
+                self._outCommand("D=M")
             elif segment == "argument":
-                out += self._outCommand("@ARG")
-                out += self._outCommand("D=M")
+                self._outCommand("@ARG")
+                self._outCommand("D=M")
             elif segment == "this":
-                out += self._outCommand("@THIS")
-                out += self._outCommand("D=M")
+                self._outCommand("@THIS")
+                self._outCommand("D=M")
             elif segment == "that":
-                out += self._outCommand("@THAT")
-                out += self._outCommand("D=M")
+                self._outCommand("@THAT")
+                self._outCommand("D=M")
             elif segment == "pointer":
-                out += self._outCommand("@3")
-                out += self._outCommand("D=A")
+                self._outCommand("@3")
+                self._outCommand("D=A")
             elif segment == "temp":
-                out += self._outCommand("@5")
-                out += self._outCommand("D=A")
+                self._outCommand("@5")
+                self._outCommand("D=A")
             elif segment == "static":
                 # static segemntの場合は標準マッピングに従ってXxx.indexシンボルを使用
-                out += self._outCommand("@"+self.vm_name+"."+str(index))
+                self._outCommand("@"+self.vm_name+"."+str(index))
 #                out += "@16\n"
-                out += self._outCommand("AD=A")
+                self._outCommand("AD=A")
             if segment != "static":
                 ## indexをAに読み込んでベースポインタとの和を求め、A, Dレジスタに保存。Aはpush用、Dはpop用
-                out += self._outCommand("@"+str(index))
-                out += self._outCommand("AD=D+A")
+                self._outCommand("@"+str(index))
+                self._outCommand("AD=D+A")
             # push or pop
             if command == "push":
                 # pushする値を取得
-                out += self._outCommand("D=M")
-                # スタックトップに書き込む
-                out += self._outCommand("@SP")
-                out += self._outCommand("A=M")
-                out += self._outCommand("M=D")
-                # スタックポインタを更新
-                out += self._outCommand("@SP")
-                out += self._outCommand("M=M+1")
+                self._outCommand("D=M")
+                # スタックトップに書き込み、スタックポインタを更新
+                self._pushD()
             elif command == "pop":
                 # 書き込み先アドレスを汎用レジスタ(R13)に保存
-                out += self._outCommand("@R13")
-                out += self._outCommand("M=D")
+                self._outCommand("@R13")
+                self._outCommand("M=D")
                 # スタックからデータをDレジスタに取得
-                out += self._outCommand("@SP")
-                out += self._outCommand("A=M-1")
-                out += self._outCommand("D=M")
+                self._outCommand("@SP")
+                self._outCommand("A=M-1")
+                self._outCommand("D=M")
                 # Dレジスタの値をメモリに書き込む
-                out += self._outCommand("@R13")
-                out += self._outCommand("A=M")
-                out += self._outCommand("M=D")
+                self._outCommand("@R13")
+                self._outCommand("A=M")
+                self._outCommand("M=D")
                 # スタックポインタを更新
-                out += self._outCommand("@SP")
-                out += self._outCommand("M=M-1")
+                self._outCommand("@SP")
+                self._outCommand("M=M-1")
+        else:
+            raise ValueError("Invalid memory segment.")
+        self._writeBuffer()
+
+    def _isDirect(self, segment, index):
+        # segment[index]のアドレスをDレジスタを使わずにAレジスタに求められるか
+        # アドレスが定数のセグメント(pointer, temp, static)とindexがSMALL_INDEX以下のlocal, argument, this, that
+        return segment in ["pointer", "temp", "static"] or (segment in SEGMENT_BASE and index <= SMALL_INDEX)
+
+    def _segmentAddress(self, segment, index):
+        # segment[index]のアドレスをDレジスタを使わずにAレジスタに求める命令列を出力する（_isDirect()がTrueの場合のみ）
+        if segment == "pointer":
+            self._outCommand("@"+str(3+index))
+        elif segment == "temp":
+            self._outCommand("@"+str(5+index))
+        elif segment == "static":
+            # static segemntの場合は標準マッピングに従ってXxx.indexシンボルを使用
+            self._outCommand("@"+self.vm_name+"."+str(index))
+        elif segment in SEGMENT_BASE and index <= SMALL_INDEX:
+            self._outCommand(SEGMENT_BASE[segment])
+            self._outCommand("A=M" if index == 0 else "A=M+1")
+            for _ in range(index-1):
+                self._outCommand("A=A+1")
+        else:
+            raise ValueError("Invalid memory segment.")
+
+    def _loadValue(self, segment, index):
+        # segment[index]の値をDレジスタに読み込む（スタックは変更しない）
+        if segment == "constant":
+            self._outCommand("@"+str(index))
+            self._outCommand("D=A")
+        elif segment in SEGMENT_BASE and index > 1:
+            # A=A+1を繰り返すより@index; A=D+Aの方が短い
+            self._outCommand(SEGMENT_BASE[segment])
+            self._outCommand("D=M")
+            self._outCommand("@"+str(index))
+            self._outCommand("A=D+A")
+            self._outCommand("D=M")
+        elif segment in SEGMENT_BASE or segment in ["pointer", "temp", "static"]:
+            self._segmentAddress(segment, index)
+            self._outCommand("D=M")
+        else:
+            raise ValueError("Invalid memory segment.")
+
+    def _pushD(self):
+        # Dレジスタの値をスタックにpushする
+        self._outCommand("@SP")
+        self._outCommand("M=M+1")
+        self._outCommand("A=M-1")
+        self._outCommand("M=D")
+
+    def _storeD(self, segment, index):
+        # Dレジスタの値をsegment[index]に書き込む
+        if self._isDirect(segment, index):
+            self._segmentAddress(segment, index)
+            self._outCommand("M=D")
+            return
+        elif segment not in SEGMENT_BASE:
+            raise ValueError("Invalid memory segment.")
+        # 値をR13、書き込み先アドレスをR14に退避して書き込む
+        self._outCommand("@R13")
+        self._outCommand("M=D")
+        self._outCommand(SEGMENT_BASE[segment])
+        self._outCommand("D=M")
+        self._outCommand("@"+str(index))
+        self._outCommand("D=D+A")
+        self._outCommand("@R14")
+        self._outCommand("M=D")
+        self._outCommand("@R13")
+        self._outCommand("D=M")
+        self._outCommand("@R14")
+        self._outCommand("A=M")
+        self._outCommand("M=D")
+
+    def writeMove(self, src, dst):
+        # push src; pop dst をスタックを経由せずに変換して出力ファイルに書き込む
+        # src, dst ... (segment, index)
+        self._outComment("move "+src[0]+" "+str(src[1])+" -> "+dst[0]+" "+str(dst[1]))
+        self._flushTOS()
+        if self._isDirect(*dst):
+            self._loadValue(*src)
+            self._storeD(*dst)
+        elif dst[0] in SEGMENT_BASE:
+            # 書き込み先アドレスを先にR13に保存してから値を読み込む
+            self._outCommand(SEGMENT_BASE[dst[0]])
+            self._outCommand("D=M")
+            self._outCommand("@"+str(dst[1]))
+            self._outCommand("D=D+A")
+            self._outCommand("@R13")
+            self._outCommand("M=D")
+            self._loadValue(*src)
+            self._outCommand("@R13")
+            self._outCommand("A=M")
+            self._outCommand("M=D")
         else:
             raise ValueError("Invalid memory segment.")
-        self.asm.write(out)
+        self._writeBuffer()
 
     def writeLabel(self, label):
-        out = "// label " + label + "\n"
+        self._outComment("label " + label)
+        self._flushTOS()
         uniq_label = self.func_name + "$" + label
-        out += "("+uniq_label+")\n"
-        self.asm.write(out)
+        self._outLabel(uniq_label)
+        self._writeBuffer()
 
     def writeGoto(self, label):
-        out = "// goto " + label + "\n"
+        self._outComment("goto " + label)
+        self._flushTOS()
         uniq_label = self.func_name + "$" + label
-        out += self._outCommand("@"+uniq_label)
-        out += self._outCommand("0;JMP")
-        self.asm.write(out)
+        self._outCommand("@"+uniq_label)
+        self._outCommand("0;JMP")
+        self._writeBuffer()
 
     def writeIf(self, label):
-        out = "// if-goto " + label + "\n"
+        self._outComment("if-goto " + label)
         uniq_label = self.func_name + "$" + label
         # Dレジスタにpop
-        out += self._outCommand("@SP")
-        out += self._outCommand("A=M-1")
-        out += self._outCommand("D=M")
-        out += self._outCommand("@SP")
-        out += self._outCommand("M=M-1")
+        if self.tos_in_d:
+            self.tos_in_d = False
+        else:
+            self._outCommand("@SP")
+            self._outCommand("A=M-1")
+            self._outCommand("D=M")
+            self._outCommand("@SP")
+            self._outCommand("M=M-1")
         # 条件ジャンプ
-        out += self._outCommand("@"+uniq_label)
-        out += self._outCommand("D;JNE")
-        self.asm.write(out)
+        self._outCommand("@"+uniq_label)
+        self._outCommand("D;JNE")
+        self._writeBuffer()
 
     def writeCall(self, func, narg):
-        out = "// call " + func + " " + str(narg) + "\n"
+        self._outComment("call " + func + " " + str(narg))
+        self._flushTOS()
         # call処理
         ## return address格納用のシンボルを作る
         rt = self._genLabel()
+        if self.shared_call:
+            # R13=関数のアドレス, R14=引数の数, R15=return addressとして共有callルーチンにジャンプ
+            for value, reg in [(rt, "R15"), (str(narg), "R14"), (func, "R13")]:
+                self._outCommand("@"+value)
+                self._outCommand("D=A")
+                self._outCommand("@"+reg)
+                self._outCommand("M=D")
+            self._outCommand("@"+CALL_ROUTINE)
+            self._outCommand("0;JMP")
+            self._outLabel(rt)
+            self._writeBuffer()
+            return
         ## return address, LCL, ARG, THIS, THATをpushする
         for label in [rt, "LCL", "ARG", "THIS", "THAT"]:
-            out += "//+++ push "+label+"\n"
-            out += self._outCommand("@"+label)
+            self._outDetail("push "+label)
+            self._outCommand("@"+label)
             if label == rt: # return addressはシンボルの値
-                out += self._outCommand("D=A")
+                self._outCommand("D=A")
             else: # segmentベースポインタはシンボルの値による参照
-                out += self._outCommand("D=M")
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M")
-            out += self._outCommand("M=D")
-            out += self._outCommand("@SP")
-            out += self._outCommand("M=M+1")
+                self._outCommand("D=M")
+            self._outCommand("@SP")
+            self._outCommand("A=M")
+            self._outCommand("M=D")
+            self._outCommand("@SP")
+            self._outCommand("M=M+1")
         # ARGをcallする関数の位置に移動 (ARG = SP-narg-5)
-        out += "//+++ ARG = SP-"+str(narg)+"-5\n"
-        out += self._outCommand("@5")
-        out += self._outCommand("D=A") #D=5
-        out += self._outCommand("@"+str(narg))
-        out += self._outCommand("D=D+A") #D=5+narg
-        out += self._outCommand("@SP")
-        out += self._outCommand("D=M-D")
-        out += self._outCommand("@ARG")
-        out += self._outCommand("M=D")
+        self._outDetail("ARG = SP-"+str(narg)+"-5")
+        self._outCommand("@5")
+        self._outCommand("D=A") #D=5
+        self._outCommand("@"+str(narg))
+        self._outCommand("D=D+A") #D=5+narg
+        self._outCommand("@SP")
+        self._outCommand("D=M-D")
+        self._outCommand("@ARG")
+        self._outCommand("M=D")
         # LCLをSPに設定 (LCL =SP)
-        out += "//+++ LCL=SP\n"
-        out += self._outCommand("@SP")
-        out += self._outCommand("D=M")
-        out += self._outCommand("@LCL")
-        out += self._outCommand("M=D")
+        self._outDetail("LCL=SP")
+        self._outCommand("@SP")
+        self._outCommand("D=M")
+        self._outCommand("@LCL")
+        self._outCommand("M=D")
         # callする関数に制御を移す
-        out += "//+++ goto "+func+"\n"
-        out += self._outCommand("@"+func)
-        out += self._outCommand("0;JMP")
+        self._outDetail("goto "+func)
+        self._outCommand("@"+func)
+        self._outCommand("0;JMP")
         # return addressラベル
-        out += "//+++ (return address)\n"
-        out += "("+rt+")\n"
+        self._outDetail("(return address)")
+        self._outLabel(rt)
         #
-        self.asm.write(out)
+        self._writeBuffer()
 
     def writeReturn(self):
-        out = "// return\n"
+        self._outComment("return")
+        self._flushTOS()
+        if self.shared_call:
+            # 共有returnルーチンにジャンプ
+            self._outCommand("@"+RETURN_ROUTINE)
+            self._outCommand("0;JMP")
+        else:
+            self._returnBody()
+        self._writeBuffer()
+
+    def _returnBody(self):
         # return処理
         ## FRAME=LCL
-        out += self._outCommand("@LCL")
-        out += self._outCommand("D=M")
-        out += self._outCommand("@FRAME")
-        out += self._outCommand("M=D")
+        self._outCommand("@LCL")
+        self._outCommand("D=M")
+        self._outCommand("@FRAME")
+        self._outCommand("M=D")
         ## RET = *(FRAME-5)
-        out += self._outCommand("@5")
-        out += self._outCommand("D=A") #D=5
-        out += self._outCommand("@FRAME")
-        out += self._outCommand("A=M-D") #A=FRAME-5
-        out += self._outCommand("D=M") #D=*(FRAME-5)
-        out += self._outCommand("@RET")
-        out += self._outCommand("M=D") #RET=*(FRAME-5)
+        self._outCommand("@5")
+        self._outCommand("D=A") #D=5
+        self._outCommand("@FRAME")
+        self._outCommand("A=M-D") #A=FRAME-5
+        self._outCommand("D=M") #D=*(FRAME-5)
+        self._outCommand("@RET")
+        self._outCommand("M=D") #RET=*(FRAME-5)
         ## *ARG = pop()
-        out += self._outCommand("@SP")
-        out += self._outCommand("A=M-1")
-        out += self._outCommand("D=M") # pop() -> D register
-        out += self._outCommand("@ARG")
-        out += self._outCommand("A=M") #A=ARG
-        out += self._outCommand("M=D") #*ARG=pop()
+        self._outCommand("@SP")
+        self._outCommand("A=M-1")
+        self._outCommand("D=M") # pop() -> D register
+        self._outCommand("@ARG")
+        self._outCommand("A=M") #A=ARG
+        self._outCommand("M=D") #*ARG=pop()
         ## SP = ARG + 1
-        out += self._outCommand("@ARG")
-        out += self._outCommand("D=M+1") #D=ARG+1
-        out += self._outCommand("@SP")
-        out += self._outCommand("M=D") #SP=ARG+1
+        self._outCommand("@ARG")
+        self._outCommand("D=M+1") #D=ARG+1
+        self._outCommand("@SP")
+        self._outCommand("M=D") #SP=ARG+1
         ## Retrieve caller segment base pointers
         for cnt, label in enumerate(["THAT", "THIS", "ARG", "LCL"]):
-            out += self._outCommand("@FRAME")
-            out += self._outCommand("AM=M-1")
-            out += self._outCommand("D=M")
-            out += self._outCommand("@"+label)
-            out += self._outCommand("M=D")
+            self._outCommand("@FRAME")
+            self._outCommand("AM=M-1")
+            self._outCommand("D=M")
+            self._outCommand("@"+label)
+            self._outCommand("M=D")
         ## goto RET
-        out += self._outCommand("@RET")
-        out += self._outCommand("A=M")
-        out += self._outCommand("0;JMP")
-        self.asm.write(out)
+        self._outCommand("@RET")
+        self._outCommand("A=M")
+        self._outCommand("0;JMP")
 
     def writeFunction(self, func, nloc):
-        out = "// function " + func +" " + str(nloc) + "\n"
-        out += "("+func+")\n"
+        self._outComment("function " + func +" " + str(nloc))
+        self._flushTOS()
+        self._outLabel(func)
         # 関数名を登録
         self.func_name = func
         # push 0 (repeat nloc times)
         for _ in range(nloc):
-            out += self._outCommand("@SP")
-            out += self._outCommand("A=M")
-            out += self._outCommand("M=0")
-            out += self._outCommand("@SP")
-            out += self._outCommand("M=M+1")
-        self.asm.write(out)
+            self._outCommand("@SP")
+            self._outCommand("A=M")
+            self._outCommand("M=0")
+            self._outCommand("@SP")
+            self._outCommand("M=M+1")
+        self._writeBuffer()
+
+    def fragment(self):
+        # 出力ファイルに書き込まずに変換結果をリンク用の断片(アセンブリ, 命令数)として返す
+        # ROMアドレスのコメントは0から始まる
+        self._flushTOS()
+        return "".join(self.buffer), self.ln
+
+    def appendFragment(self, fragment):
+        # fragment()で取り出した断片を連結する。ROMアドレスのコメントは連結位置に合わせて振り直す
+        text, length = fragment
+        offset = self.ln
+        if offset and self.rom_comments:
+            text = ROM_COMMENT.sub(lambda m: " // "+str(int(m.group(1))+offset), text)
+        self.buffer.append(text)
+        self.ln += length
+
+    def mark(self):
+        # 断片の現在の位置を返す（truncate()でこれより後ろの出力を取り消すため）
+        self._flushTOS()
+        return len(self.buffer), self.ln, self.label_id, self.func_name
+
+    def truncate(self, mark):
+        # mark()の位置より後ろの出力を取り消し、取り消した命令数を返す。fragment()で取り出す場合のみ使える
+        self._flushTOS()
+        length, ln, label_id, func_name = mark
+        del self.buffer[length:]
+        removed = self.ln - ln
+        self.ln, self.label_id, self.func_name = ln, label_id, func_name
+        return removed
+
+    def close(self):
+        self._flushTOS()
+        self._writeBuffer(force=True)
+        if self.own_file:
+            self.asm.close()
+
+
+def _importAssembler():
+    #
+    # 06のアセンブラのエンコーダとシンボル解決を再利用する
+    # --hackのときだけimportするので、それ以外では06が無くても動く
+    #
+    if ASSEMBLER_DIR not in sys.path:
+        sys.path.append(ASSEMBLER_DIR)
+    import Assembler
+    return Assembler
+
+
+class HackWriter(CodeWriter):
+    #
+    # アセンブリのテキストを経由せずにHackの機械語(.hack)を出力するCodeWriter
+    # バッファにはアセンブラのInstructionレコードを貯め、close()でシンボルを解決して書き込む
+    #
+    def __init__(self, outfile, **options):
+        options["rom_comments"] = False
+        super().__init__(None, **options)
+        self.hack_file = outfile
+        self.assembler = _importAssembler()
+
+    def _outCommand(self, cmd):
+        asm = self.assembler
+        if cmd[0] == "@":
+            self.buffer.append(asm.Instruction(asm.A_COMMAND, cmd[1:]))
+        else:
+            self.buffer.append(asm.Instruction(asm.C_COMMAND, cmd))
+        self.ln += 1
+
+    def _outLabel(self, label):
+        asm = self.assembler
+        self.buffer.append(asm.Instruction(asm.L_COMMAND, label))
+
+    def _outComment(self, comment):
+        pass
+
+    def _outDetail(self, comment):
+        pass
+
+    def _writeBuffer(self, force=False):
+        pass
+
+    def fragment(self):
+        self._flushTOS()
+        return self.buffer, self.ln
+
+    def appendFragment(self, fragment):
+        # ラベルはシンボルのまま持っているので位置の振り直しは不要
+        instructions, length = fragment
+        self.buffer.extend(instructions)
+        self.ln += length
 
     def close(self):
-        self.asm.close()
+        self._flushTOS()
+        asm = self.assembler
+        hack = asm.assembleOnePass(self.buffer, asm.SymbolTable(), asm.Code())
+        if self.hack_file is not None:
+            asm.writeHack(self.hack_file, hack)
+        return hack
 
 #
-# Main program
+# VM中間表現（IR）と最適化パス
 #
-parser = argparse.ArgumentParser(description="VM translator")
-parser.add_argument("prog", help="program directory")
+def parseCommand(command):
+    #
+    # 1行のコマンドを1度だけ分割し、COMMAND_TYPESで種類を引いてVMCommandを返す
+    #
+    token = command.split()
+    cmd_type = COMMAND_TYPES.get(token[0].lower())
+    if cmd_type is None:
+        raise ValueError("Invalid type of command: "+command.strip())
+    if cmd_type == C_ARITHMETIC:
+        return VMCommand(cmd_type, token[0].lower(), None)
+    elif cmd_type == C_RETURN:
+        return VMCommand(cmd_type, None, None)
+    elif cmd_type in (C_PUSH, C_POP, C_FUNCTION, C_CALL):
+        return VMCommand(cmd_type, token[1], int(token[2]))
+    return VMCommand(cmd_type, token[1], None)
+
+def parseFile(vm):
+    #
+    # .vmファイルの全コマンドを1パスで読み込み、VMCommandのリストを返す
+    #
+    return Parser(vm).parseAll()
+
+def splitFunctions(commands):
+    #
+    # コマンド列をfunctionコマンドごとのブロックに分割する
+    # 最初のfunctionより前のコマンドは先頭のブロックになる
+    #
+    blocks = [[]]
+    for cmd in commands:
+        if cmd.type == C_FUNCTION and blocks[-1]:
+            blocks.append([])
+        blocks[-1].append(cmd)
+    return [block for block in blocks if block]
+
+def _foldValue(command, a, b=None):
+    #
+    # 定数の演算結果を16bitで求める
+    #
+    if command == "add":
+        value = a + b
+    elif command == "sub":
+        value = a - b
+    elif command == "and":
+        value = a & b
+    elif command == "or":
+        value = a | b
+    elif command == "neg":
+        value = -a
+    elif command == "not":
+        value = ~a
+    elif command == "eq":
+        value = -1 if a == b else 0
+    elif command == "gt":
+        value = -1 if a > b else 0
+    elif command == "lt":
+        value = -1 if a < b else 0
+    return value & 0xFFFF
+
+def foldConstants(block):
+    #
+    # push constant a; push constant b; <op> → push constant (a op b)
+    # push constant a; neg/not → push constant (op a)
+    # 結果が負数（比較のtrueなど）のときは push constant (~結果); not で表す
+    #
+    out = []
+    for cmd in block:
+        out.append(cmd)
+        while out[-1].type == C_ARITHMETIC:
+            op = out[-1].arg1
+            if op in ["neg", "not"]:
+                operands = out[-2:-1]
+            else:
+                operands = out[-3:-1]
+            if len(operands) != (1 if op in ["neg", "not"] else 2) or \
+               any(c.type != C_PUSH or c.arg1 != "constant" for c in operands):
+                break
+            value = _foldValue(op, *[c.arg2 for c in operands])
+            del out[-len(operands)-1:]
+            if value < 0x8000:
+                out.append(VMCommand(C_PUSH, "constant", value))
+            else:
+                out.append(VMCommand(C_PUSH, "constant", ~value & 0xFFFF))
+                out.append(VMCommand(C_ARITHMETIC, "not", None))
+                break
+    return out
+
+def removeDeadCode(block):
+    #
+    # goto, returnの後ろで次のlabel, functionまでのコマンドを削除する
+    #
+    out = []
+    dead = False
+    for cmd in block:
+        if cmd.type in [C_LABEL, C_FUNCTION]:
+            dead = False
+        if not dead:
+            out.append(cmd)
+        if cmd.type in [C_GOTO, C_RETURN]:
+            dead = True
+    return out
+
+def fusePushPop(block):
+    #
+    # push x; pop x → 削除
+    # push x; pop y → move x y
+    #
+    out = []
+    for cmd in block:
+        if cmd.type == C_POP and out and out[-1].type == C_PUSH:
+            push = out.pop()
+            if (push.arg1, push.arg2) != (cmd.arg1, cmd.arg2):
+                out.append(VMCommand(C_MOVE, (push.arg1, push.arg2), (cmd.arg1, cmd.arg2)))
+        else:
+            out.append(cmd)
+    return out
+
+def callGraph(commands):
+    #
+    # 関数名 -> その関数がcallする関数名の集合 の辞書を返す
+    #
+    graph = {}
+    for block in splitFunctions(commands):
+        if block[0].type == C_FUNCTION:
+            graph[block[0].arg1] = {cmd.arg1 for cmd in block if cmd.type == C_CALL}
+    return graph
 
-args = parser.parse_args()
-prog_dir = args.prog
+def reachableFunctions(graph, root="Sys.init"):
+    #
+    # rootから呼び出しをたどって到達できる関数名の集合を返す
+    #
+    reachable = {root}
+    stack = [root]
+    while stack:
+        for callee in graph.get(stack.pop(), ()):
+            if callee not in reachable:
+                reachable.add(callee)
+                stack.append(callee)
+    return reachable
+
+OPTIMIZATION_PASSES = [foldConstants, removeDeadCode, fusePushPop]
+
+def optimize(commands):
+    #
+    # 関数ブロックごとに最適化パスを適用したコマンド列を返す
+    #
+    out = []
+    for block in splitFunctions(commands):
+        for optimization in OPTIMIZATION_PASSES:
+            block = optimization(block)
+        out.extend(block)
+    return out
+
+def writeCommands(writer, commands):
+    #
+    # VMCommandのリストをCodeWriterで変換する
+    #
+    for cmd in commands:
+        if cmd.type == C_ARITHMETIC:
+            writer.writeArithmetic(cmd.arg1)
+        elif cmd.type == C_PUSH:
+            writer.writePushPop("push", cmd.arg1, cmd.arg2)
+        elif cmd.type == C_POP:
+            writer.writePushPop("pop", cmd.arg1, cmd.arg2)
+        elif cmd.type == C_MOVE:
+            writer.writeMove(cmd.arg1, cmd.arg2)
+        elif cmd.type == C_LABEL:
+            writer.writeLabel(cmd.arg1)
+        elif cmd.type == C_GOTO:
+            writer.writeGoto(cmd.arg1)
+        elif cmd.type == C_IF:
+            writer.writeIf(cmd.arg1)
+        elif cmd.type == C_CALL:
+            writer.writeCall(cmd.arg1, cmd.arg2)
+        elif cmd.type == C_RETURN:
+            writer.writeReturn()
+        elif cmd.type == C_FUNCTION:
+            writer.writeFunction(cmd.arg1, cmd.arg2)
 
-if not os.path.exists(prog_dir):
-    print("Error: "+prog_dir+" does not exist.")
-    sys.exit(1)
 
 #
-# Start code generation
+# ファイル単位の変換とリンク
 #
-## output file name
-asmfile = os.path.join(os.path.basename(prog_dir), ".asm").replace(os.sep, "")
-## CodeWriter instance
-writer = CodeWriter(os.path.join(prog_dir, asmfile))
+ROM_COMMENT = re.compile(r" // (\d+)$", re.M)
 
-## Bootstrap
-writer.writeInit()
-
-## Process .vm files
-for vm in glob.glob(os.path.join(prog_dir, "*.vm")):
-    psr = Parser(vm)
+def translateFile(vm, optimize_ir=False, hack=False, reachable=None, commands=None, **options):
+    #
+    # 1つの.vmファイルを独立した断片に変換する（プロセスプール内でも実行される）
+    # reachable ... 出力する関数名の集合。Noneなら全ての関数を出力
+    # commands ... 解析済みのVMCommandのリスト。Noneならvmを解析する
+    # 戻り値: (CodeWriter.fragment()（hackがTrueならHackWriter.fragment()）の結果, 取り除いた関数の命令数)
+    #
+    writer = (HackWriter if hack else CodeWriter)(None, **options)
+    if commands is None:
+        commands = parseFile(vm)
+    if optimize_ir:
+        commands = optimize(commands)
     writer.setFileName(vm)
-    while psr.hasMoreCommands():
-        psr.advance()
-        cmd_type = psr.commandType()
-        if cmd_type == C_ARITHMETIC:
-            writer.writeArithmetic(psr.arg1())
-        elif cmd_type == C_PUSH:
-            writer.writePushPop("push", psr.arg1(), psr.arg2())
-        elif cmd_type == C_POP:
-            writer.writePushPop("pop", psr.arg1(), psr.arg2())
-        elif cmd_type == C_LABEL:
-            writer.writeLabel(psr.arg1())
-        elif cmd_type == C_GOTO:
-            writer.writeGoto(psr.arg1())
-        elif cmd_type == C_IF:
-            writer.writeIf(psr.arg1())
-        elif cmd_type == C_CALL:
-            writer.writeCall(psr.arg1(), psr.arg2())
-        elif cmd_type == C_RETURN:
-            writer.writeReturn()
-        elif cmd_type == C_FUNCTION:
-            writer.writeFunction(psr.arg1(), psr.arg2())
+    if reachable is None:
+        writeCommands(writer, commands)
+        return writer.fragment(), 0
+    # 到達できない関数は変換して命令数を数えてから断片から取り除く
+    saved = 0
+    for block in splitFunctions(commands):
+        dead = block[0].type == C_FUNCTION and block[0].arg1 not in reachable
+        if dead:
+            mark = writer.mark()
+        writeCommands(writer, block)
+        if dead:
+            saved += writer.truncate(mark)
+    return writer.fragment(), saved
+
+def link(writer, fragments):
+    #
+    # ブートストラップを書き込んだwriterの後ろに断片を順に連結する
+    #
+    for fragment in fragments:
+        writer.appendFragment(fragment)
+
+def translate(prog_dir, jobs=1, optimize_ir=False, hack=False, eliminate_dead=False, **options):
+    #
+    # prog_dir下の.vmファイルを変換してprog_dir.asm（hackがTrueならprog_dir.hack）を出力する
+    # jobsが1でなければファイルごとの変換をプロセスプールで並列に行う（Noneの場合はCPU数）
+    # eliminate_deadがTrueならSys.initから到達できない関数を出力せず、削減量を表示する
+    #
+    outfile = os.path.join(os.path.basename(prog_dir), ".hack" if hack else ".asm").replace(os.sep, "")
+    vms = sorted(glob.glob(os.path.join(prog_dir, "*.vm")))
+    writer = (HackWriter if hack else CodeWriter)(os.path.join(prog_dir, outfile), **options)
+    reachable = None
+    parsed = [None] * len(vms)
+    if eliminate_dead:
+        # 呼び出しグラフ用に解析したコマンド列をそのまま変換にも使う
+        parsed = [parseFile(vm) for vm in vms]
+        graph = callGraph([cmd for commands in parsed for cmd in commands])
+        if "Sys.init" in graph:
+            reachable = reachableFunctions(graph)
         else:
-            raise ValueError("Invalid type of command: "+psr.command)
+            print("Warning: Sys.init is not defined; dead function elimination is skipped.")
+    writer.writeInit()
+    if jobs == 1 or len(vms) < 2:
+        results = [translateFile(vm, optimize_ir, hack, reachable, commands, **options)
+                   for vm, commands in zip(vms, parsed)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(translateFile, vm, optimize_ir, hack, reachable, commands, **options)
+                       for vm, commands in zip(vms, parsed)]
+            results = [future.result() for future in futures]
+    link(writer, [fragment for fragment, _ in results])
+    writer.close()
+    if reachable is not None:
+        saved = sum(saved for _, saved in results)
+        removed = len(graph.keys() - reachable)
+        print("Removed", removed, "unreachable functions:", saved, "words ("+str(saved*2)+" bytes) of", writer.ln+saved)
+
+
+#
+# Main program
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="VM translator")
+    parser.add_argument("prog", help="program directory")
+    parser.add_argument("--shared-call", action="store_true",
+                        help="Emit one global call/return routine instead of inlining every call and return")
+    parser.add_argument("--shared-compare", action="store_true",
+                        help="Emit one eq/gt/lt routine each instead of inlining every comparison")
+    parser.add_argument("--cache-tos", action="store_true",
+                        help="Keep the top of the stack in the D register between VM commands")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Run the VM-level optimization passes before code generation")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="Number of worker processes translating .vm files (0: number of CPUs)")
+    parser.add_argument("--eliminate-dead", action="store_true",
+                        help="Emit only the functions reachable from Sys.init in the call graph")
+    parser.add_argument("--hack", action="store_true",
+                        help="Write Hack machine code (.hack) directly instead of assembly (.asm)")
+    parser.add_argument("--no-rom-comments", action="store_true",
+                        help="Do not append the // <rom address> debug comment to each instruction")
+
+    args = parser.parse_args(argv)
+    prog_dir = args.prog
+
+    if not os.path.exists(prog_dir):
+        print("Error: "+prog_dir+" does not exist.")
+        sys.exit(1)
+
+    translate(prog_dir, jobs=args.jobs or None, optimize_ir=args.optimize, hack=args.hack,
+              eliminate_dead=args.eliminate_dead,
+              shared_call=args.shared_call, shared_compare=args.shared_compare, cache_tos=args.cache_tos,
+              rom_comments=not args.no_rom_comments)
+
 
-writer.close()
+if __name__ == "__main__":
+    main()
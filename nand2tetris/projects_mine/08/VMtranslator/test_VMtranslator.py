@@ -0,0 +1,107 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import VMtranslator
+from VMtranslator import VMCommand, C_ARITHMETIC, C_PUSH, C_POP, C_LABEL, C_GOTO, C_MOVE
+
+# 変換結果の実行には06のアセンブラを使う
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "06", "Assembler"))
+import Assembler
+
+
+def push(segment, index):
+    return VMCommand(C_PUSH, segment, index)
+
+def pop(segment, index):
+    return VMCommand(C_POP, segment, index)
+
+def arithmetic(command):
+    return VMCommand(C_ARITHMETIC, command, None)
+
+
+def run_hack(words, ram_init, cycles=10000):
+    #
+    # Hack CPUの最小限のエミュレータ。ROMの末尾まで実行してRAMを返す
+    #
+    ram = [0] * 32768
+    for address, value in ram_init.items():
+        ram[address] = value
+    a = d = pc = 0
+    for _ in range(cycles):
+        if pc >= len(words):
+            break
+        w = words[pc]
+        if w & 0x8000 == 0:
+            a = w
+            pc += 1
+            continue
+        c = (w >> 6) & 0x3F
+        x = d
+        y = ram[a] if w & 0x1000 else a
+        if c & 0x20: x = 0
+        if c & 0x10: x = ~x & 0xFFFF
+        if c & 0x08: y = 0
+        if c & 0x04: y = ~y & 0xFFFF
+        out = (x + y) & 0xFFFF if c & 0x02 else x & y
+        if c & 0x01: out = ~out & 0xFFFF
+        address = a
+        if w & 0x08: ram[address] = out
+        if w & 0x20: a = out
+        if w & 0x10: d = out
+        negative, zero = out & 0x8000, out == 0
+        jump = (w & 4 and negative) or (w & 2 and zero) or (w & 1 and not negative and not zero)
+        pc = address if jump else pc + 1
+    return ram
+
+
+class OptimizationPassTest(unittest.TestCase):
+    def test_fold_arithmetic_chain(self):
+        block = [push("constant", 2), push("constant", 3), arithmetic("add"),
+                 push("constant", 4), arithmetic("sub")]
+        self.assertEqual(VMtranslator.foldConstants(block), [push("constant", 1)])
+
+    def test_fold_comparison(self):
+        # falseは0、trueは-1（push constant 0; not）に畳み込む
+        false = [push("constant", 3), push("constant", 5), arithmetic("gt")]
+        true = [push("constant", 5), push("constant", 3), arithmetic("gt")]
+        self.assertEqual(VMtranslator.foldConstants(false), [push("constant", 0)])
+        self.assertEqual(VMtranslator.foldConstants(true), [push("constant", 0), arithmetic("not")])
+
+    def test_remove_dead_code_after_goto(self):
+        block = [VMCommand(C_GOTO, "END", None), push("constant", 1), pop("local", 0),
+                 VMCommand(C_LABEL, "END", None), push("constant", 2), pop("local", 1)]
+        self.assertEqual(VMtranslator.removeDeadCode(block),
+                         [VMCommand(C_GOTO, "END", None),
+                          VMCommand(C_LABEL, "END", None), push("constant", 2), pop("local", 1)])
+
+    def test_fuse_push_pop(self):
+        block = [push("pointer", 0), pop("this", 10)]
+        fused = VMtranslator.fusePushPop(block)
+        self.assertEqual(fused, [VMCommand(C_MOVE, ("pointer", 0), ("this", 10))])
+        # 融合前後の変換結果を実行して同じ結果になること
+        # R13-R15（作業用）とSPより上のスタック（未使用領域）は比較しない
+        ram_init = {0: 256, 1: 300, 2: 400, 3: 3000, 4: 4000}
+        results = []
+        for commands in (block, fused):
+            ram = run_hack(self._assemble(commands), ram_init)
+            self.assertEqual(ram[3010], 3000)
+            sp = ram[0]
+            results.append(ram[:13] + ram[16:sp] + ram[sp+16:])
+        self.assertEqual(results[0], results[1])
+
+    def _assemble(self, commands):
+        with tempfile.TemporaryDirectory() as tmp:
+            asm_file = os.path.join(tmp, "Test.asm")
+            writer = VMtranslator.CodeWriter(asm_file)
+            writer.setFileName("Test.vm")
+            VMtranslator.writeCommands(writer, commands)
+            writer.close()
+            with open(asm_file) as fin:
+                return Assembler.assemble(fin.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,7 @@ import re
 import glob
 import argparse
 import collections
+import mmap
 
 #
 # Token container
@@ -15,7 +16,6 @@ Token = collections.namedtuple("Token", ["type", "value"])
 #
 T_COMMENT1   = "COMMENT1"
 T_COMMENT2   = "COMMENT2"
-T_COMMENT3   = "COMMENT3"
 T_SKIP       = "SKIP"
 T_STR_CONST  = "stringConstant"
 T_INT_CONST  = "integerConstant"
@@ -25,21 +25,30 @@ T_IDENTIFIER = "identifier"
 T_MISMATCH   = "MISMATCH"
 
 token_spcification = [
-    (T_COMMENT1, r"//.*"), # comments: //...
-    (T_COMMENT2, r"/\*[\s\S]*?\*/"), # comments: /* ... */
-    (T_COMMENT3, r"/\*\*[\s\S]*?\*/"), # comments: /** ... */
-    (T_STR_CONST, r"\".*?\""),  # string constants (double quotations are involved)
-    (T_SKIP, r"\s+|\n+"), # spaces, tabs, new lines
+    (T_COMMENT1, r"//[^\n]*"), # comments: //...
+    (T_COMMENT2, r"/\*[^*]*\*+(?:[^/*][^*]*\*+)*/"), # comments: /* ... */ and /** ... */ (no backtracking)
+    (T_STR_CONST, r"\"[^\"\n]*\""),  # string constants (double quotations are involved)
+    (T_SKIP, r"\s+"), # spaces, tabs, new lines
     (T_SYMBOL, r"[{}\(\)\[\],.;\+\-\*/&\|<>=~]"), # symbols
-    (T_KEYWORD, r"class|constructor|function|method|field|static|var|int|char|boolean|void|true|false|null|this|let|do|if|else|while|return"),  # keywords
-    (T_IDENTIFIER, r"\b[a-zA-Z_][a-zA-Z0-9_]*\b"), # identifiers
-    (T_INT_CONST, r"\b\d+\b"), # integer constants
+    (T_IDENTIFIER, r"[a-zA-Z_][a-zA-Z0-9_]*"), # identifiers and keywords (classified by Jack_keywords)
+    (T_INT_CONST, r"\d+"), # integer constants
     (T_MISMATCH, r"."), # any other characters
 ]
 
+Jack_keywords = frozenset(["class", "constructor", "function", "method", "field", "static", "var",
+                           "int", "char", "boolean", "void", "true", "false", "null", "this",
+                           "let", "do", "if", "else", "while", "return"])
+
+#
+# Precompiled lexer (str and bytes patterns)
+#
+tok_regex = re.compile("|".join("(?P<%s>%s)" % pair for pair in token_spcification))
+tok_regex_bytes = re.compile(tok_regex.pattern.encode())
+
 Jack_operators = ["+", "-", "*", "/", "&", "|", "<", ">", "="]
 Jack_unary_ops = ["~", "-"]
 Jack_kw_constants = ["true", "false", "null", "this"]
+XML_ESCAPES = {"<": "&lt;", ">": "&gt;", "&": "&amp;"}
 
 #
 # Function definitions
@@ -74,11 +83,37 @@ def punch_tokens_to_xml(tokenizer):
                 raise ValueError("Invalid token type.")
         fout.write("</tokens>\n")
 
+def iter_tokens(source_file):
+    #
+    # ソースファイルをmmapしてバイト列の正規表現で先頭から走査し、トークンを1つずつyieldする
+    # ファイル全体の読み込みやトークンのリストは作らない
+    #
+    with open(source_file, "rb") as fin:
+        if os.fstat(fin.fileno()).st_size == 0: # 空のファイルはmmapできない
+            return
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for mo in tok_regex_bytes.finditer(buf):
+                type = mo.lastgroup
+                if type == T_SKIP or type == T_COMMENT1 or type == T_COMMENT2:
+                    continue
+                value = mo.group().decode()
+                if type == T_IDENTIFIER:
+                    yield Token(T_KEYWORD if value in Jack_keywords else T_IDENTIFIER, value)
+                elif type == T_STR_CONST:
+                    yield Token(type, value[1:-1])
+                elif type == T_MISMATCH:
+                    raise RuntimeError(f"{value!r} unexpected.")
+                else:
+                    yield Token(type, value)
+
 #
 # Class definitions
 #
 class JackAnalyzer():
-    def __init__(self, source):
+    def __init__(self, source, lazy=False, xml=True):
+        self.lazy = lazy
+        self.xml = xml
+        self.trees = {} # ソースファイル名 -> AST(ClassDec)
         if os.path.isdir(source):
             self.src_files = sorted(glob.glob(os.path.join(source, "*.jack")))
         elif os.path.isfile(source):
@@ -94,7 +129,10 @@ class JackAnalyzer():
             print("Compiling "+src_file)
             #
             # Tokenizer instance
-            tknzr = JackTokenizer(src_file)
+            if self.lazy:
+                tknzr = LazyJackTokenizer(src_file)
+            else:
+                tknzr = JackTokenizer(src_file)
             #
             # Punch out tokens
             # *** For testing JackTokenizer class only
@@ -104,10 +142,12 @@ class JackAnalyzer():
             #
             # CompilationEngine instance
             ce = CompilationEngine(tknzr)
-            # Start compilation
-            ce.compileClass()
-            # End of compilation
-            ce.finalize()
+            # Start compilation; the result is an AST
+            tree = ce.compileClass()
+            self.trees[src_file] = tree
+            # Serialize the AST to xml
+            if self.xml:
+                XMLWriter().write(tree, src_file.replace(".jack", ".xml"))
         print("Compilation ended successfully.")
 
 
@@ -118,37 +158,48 @@ class JackTokenizer():
         with open(source_file, "r") as fin:
             source_text = fin.read()
         # Tokenize
+        # identifierにマッチした語はJack_keywordsに含まれていればkeywordとする
         tmp_list = []
-        tok_regex = "|".join("(?P<%s>%s)" % pair for pair in token_spcification)
-        for mo in re.finditer(tok_regex, source_text):
+        for mo in tok_regex.finditer(source_text):
             type = mo.lastgroup
-            value = mo.group()
-            if type in [T_COMMENT1, T_COMMENT2, T_COMMENT3, T_SKIP]:
+            if type == T_SKIP or type == T_COMMENT1 or type == T_COMMENT2:
                 continue
-            elif type in [T_SYMBOL, T_KEYWORD, T_STR_CONST, T_INT_CONST, T_IDENTIFIER]:
-                value = value.replace('"', '')
-                tmp_list.append(Token(type, value))
-            else:
+            value = mo.group()
+            if type == T_IDENTIFIER:
+                tmp_list.append(Token(T_KEYWORD if value in Jack_keywords else T_IDENTIFIER, value))
+            elif type == T_STR_CONST:
+                tmp_list.append(Token(type, value[1:-1]))
+            elif type == T_MISMATCH:
                 raise RuntimeError(f"{value!r} unexpected.")
+            else:
+                tmp_list.append(Token(type, value))
         #
-        self.token_list = tmp_list
-        self.next_token = self.token_list[0]
+        # トークン列は変更せず、読み出し位置(cursor)だけを進める
+        self.tokens = tuple(tmp_list)
+        self.cursor = 0
+        self.next_token = self.peek(1)
         self.current_token = None
 
     def hasMoreTokens(self):
-        if self.token_list:
-            return True
-        else:
-            return False
+        return self.cursor < len(self.tokens)
 
     def advance(self):
-        self.current_token = self.token_list[0]
-        del self.token_list[0]
-        if self.token_list: # token_list is not empty yet
-            self.next_token = self.token_list[0]
-        else:               # token_list has been consumed
+        self.current_token = self.tokens[self.cursor]
+        self.cursor += 1
+        if self.cursor < len(self.tokens): # tokens are not consumed yet
+            self.next_token = self.tokens[self.cursor]
+        else:                              # tokens have been consumed
             self.next_token = None
 
+    def peek(self, k=1):
+        #
+        # k個先のトークンを返す（読み進めない）。peek(1)はnext_tokenと同じ。範囲外ならNone
+        #
+        pos = self.cursor + k - 1
+        if 0 <= pos < len(self.tokens):
+            return self.tokens[pos]
+        return None
+
     def tokenType(self):
         return self.current_token.type
 
@@ -168,53 +219,118 @@ class JackTokenizer():
         return self.current_token.value
 
 
-class CompilationEngine():
-    def __init__(self, tokenizer):
-        #
-        # 初期化
-        #
-        self.tokenizer = tokenizer
-        self.fout = open(tokenizer.source_file.replace(".jack", ".xml"), "w")
-        self.indent = "  "
-        self.indent_level = 0
+class LazyJackTokenizer(JackTokenizer):
+    #
+    # トークンをiter_tokens()から必要になった時点で読み込むトークナイザ
+    # 先読みしたトークン（peek()で要求された分だけ）はself.lookaheadに保持する
+    #
+    def __init__(self, source_file):
+        self.source_file = source_file
+        self.stream = iter_tokens(source_file)
+        self.lookahead = collections.deque()
+        self.next_token = self.peek(1)
+        self.current_token = None
 
-    def finalize(self):
-        #
-        # 終了処理
-        #
-        self.fout.close()
+    def hasMoreTokens(self):
+        return self.next_token is not None
 
-    def _to_xml(self, tag, val):
-        #
-        # 終端記号をxml形式で出力: <tag> val </tag>
-        #
-        self.fout.write(self.indent_level * self.indent + "<" + tag + ">")
-        if val == "<":
-            val = "&lt;"
-        elif val == ">":
-            val = "&gt;"
-        elif val == "&":
-            val = "&amp;"
-        self.fout.write(" " + val +" ")
-        self.fout.write("</" + tag + ">\n")
+    def advance(self):
+        self.current_token = self.lookahead.popleft()
+        self.next_token = self.peek(1)
 
-    def _open_tag(self, tag):
-        #
-        # 非終端記号の開タグを出力
-        #
-        self.fout.write(self.indent_level * self.indent + "<"+tag+">\n")
-        self.indent_level += 1
+    def peek(self, k=1):
+        while len(self.lookahead) < k:
+            token = next(self.stream, None)
+            if token is None:
+                return None
+            self.lookahead.append(token)
+        return self.lookahead[k-1]
 
-    def _close_tag(self, tag):
+
+#
+# AST node definitions
+#
+class Node():
+    #
+    # ASTノードの基底クラス。フィールドは__slots__の順に位置引数で受け取る
+    #
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(repr(getattr(self, name)) for name in self.__slots__) + ")"
+
+## program structure
+class ClassDec(Node):
+    __slots__ = ("name", "class_var_decs", "subroutine_decs")
+
+class ClassVarDec(Node):
+    __slots__ = ("kind", "type", "names") # kind: static | field
+
+class SubroutineDec(Node):
+    __slots__ = ("kind", "return_type", "name", "parameters", "var_decs", "statements") # parameters: [(type, name)]
+
+class VarDec(Node):
+    __slots__ = ("type", "names")
+
+## statements
+class LetStatement(Node):
+    __slots__ = ("name", "index", "value") # index: Expression or None
+
+class IfStatement(Node):
+    __slots__ = ("condition", "statements", "else_statements") # else_statements: list or None
+
+class WhileStatement(Node):
+    __slots__ = ("condition", "statements")
+
+class DoStatement(Node):
+    __slots__ = ("call",)
+
+class ReturnStatement(Node):
+    __slots__ = ("value",) # value: Expression or None
+
+## expressions
+class Expression(Node):
+    __slots__ = ("terms", "ops") # terms[0] ops[0] terms[1] ops[1] ...
+
+class IntegerConstant(Node):
+    __slots__ = ("value",)
+
+class StringConstant(Node):
+    __slots__ = ("value",)
+
+class KeywordConstant(Node):
+    __slots__ = ("value",)
+
+class VarTerm(Node):
+    __slots__ = ("name",)
+
+class ArrayTerm(Node):
+    __slots__ = ("name", "index")
+
+class SubroutineCall(Node):
+    __slots__ = ("receiver", "name", "arguments") # receiver: className | varName | None
+
+class ParenTerm(Node):
+    __slots__ = ("expression",)
+
+class UnaryTerm(Node):
+    __slots__ = ("op", "term")
+
+
+class CompilationEngine():
+    def __init__(self, tokenizer):
         #
-        # 非終端記号の閉タグを出力
+        # 初期化
         #
-        self.indent_level -= 1
-        self.fout.write(self.indent_level * self.indent + "</"+tag+">\n")
+        self.tokenizer = tokenizer
 
     def _expect(self, type=None, values=None):
         #
-        # トークンを一つ読み進んで出力する
+        # トークンを一つ読み進んでその値を返す
         # type ... 期待されるトークンタイプ。異なっていた場合エラー停止
         # values ... 取りうる値のリスト(optional)。これ以外のvalueであった場合はエラー停止
         #
@@ -223,279 +339,454 @@ class CompilationEngine():
             tk.advance()
         else:
             raise RuntimeError("Unexpected end of tokens.")
-        if tk.tokenType() == type:
-            if values:
-                if tk.current_token.value in values:
-                    self._to_xml(type, tk.current_token.value)
-                else:
-                    raise RuntimeError("Expected token value(s): " + str(values) + ", but got " + tk.current_token.value)
-            else:
-                self._to_xml(type, tk.current_token.value)
-        else:
-            raise RuntimeError("Expected token type: " + type + ", but got " + tk.tokenType())
+        token = tk.current_token
+        if token.type != type:
+            raise RuntimeError("Expected token type: " + type + ", but got " + token.type)
+        if values and token.value not in values:
+            raise RuntimeError("Expected token value(s): " + str(values) + ", but got " + token.value)
+        return token.value
+
+    def _type(self, keywords):
+        #
+        # 型（組み込み型のkeywordまたはクラス名のidentifier）を読む
+        #
+        if self.tokenizer.next_token.type == T_KEYWORD:
+            return self._expect(type=T_KEYWORD, values=keywords)
+        return self._expect(type=T_IDENTIFIER)
 
     def compileClass(self):
         tk = self.tokenizer
-        self._open_tag("class")
         self._expect(type=T_KEYWORD, values=["class"])
         # class name
-        self._expect(type=T_IDENTIFIER)
+        name = self._expect(type=T_IDENTIFIER)
         # open brace
         self._expect(type=T_SYMBOL, values=["{"])
         # class variable decleration
+        class_var_decs = []
         while tk.next_token.value in ["static", "field"]:
-            self.compileClassVarDec()
+            class_var_decs.append(self.compileClassVarDec())
         # subroutines
+        subroutine_decs = []
         while tk.next_token.value in ["constructor", "function", "method"]:
-            self.compileSubroutine()
+            subroutine_decs.append(self.compileSubroutine())
         # close brace
         self._expect(type=T_SYMBOL, values=["}"])
-        self._close_tag("class")
+        return ClassDec(name, class_var_decs, subroutine_decs)
 
     def compileClassVarDec(self):
-        self._open_tag("classVarDec")
         tk = self.tokenizer
         # static or field
-        self._expect(type=T_KEYWORD, values=["static", "field"])
+        kind = self._expect(type=T_KEYWORD, values=["static", "field"])
         # type
-        if tk.next_token.type == T_KEYWORD: ## built-in type
-            self._expect(type=T_KEYWORD, values=["int", "char", "boolean"])
-        else: ## class
-            self._expect(type=T_IDENTIFIER)
+        type = self._type(["int", "char", "boolean"])
         # first varName
-        self._expect(type=T_IDENTIFIER)
+        names = [self._expect(type=T_IDENTIFIER)]
         # other varNames
         while tk.next_token.value != ";":
             self._expect(type=T_SYMBOL, values=[","])
-            self._expect(type=T_IDENTIFIER)
+            names.append(self._expect(type=T_IDENTIFIER))
         # end of classVar declaretion
         self._expect(type=T_SYMBOL, values=[";"])
-        self._close_tag("classVarDec")
+        return ClassVarDec(kind, type, names)
 
     def compileSubroutine(self):
         tk = self.tokenizer
-        self._open_tag(tag="subroutineDec")
         # subroutine type
-        self._expect(type=T_KEYWORD, values=["constructor", "function", "method"])
+        kind = self._expect(type=T_KEYWORD, values=["constructor", "function", "method"])
         # return value type
-        if tk.next_token.type == T_KEYWORD:
-            self._expect(type=T_KEYWORD, values=["void", "int", "char", "boolean"])
-        else:
-            self._expect(type=T_IDENTIFIER)
+        return_type = self._type(["void", "int", "char", "boolean"])
         # subroutine name
-        self._expect(type=T_IDENTIFIER)
+        name = self._expect(type=T_IDENTIFIER)
         # arguments
         self._expect(type=T_SYMBOL, values=["("])
-        self.compileParameterList()
+        parameters = self.compileParameterList()
         self._expect(type=T_SYMBOL, values=[")"])
         # subroutine body
-        self._open_tag(tag="subroutineBody")
         self._expect(type=T_SYMBOL, values=["{"])
         ## varDec
+        var_decs = []
         while tk.next_token.value == "var":
-            self.compileVarDec()
+            var_decs.append(self.compileVarDec())
         ## statements
-        self.compileStatements()
+        statements = self.compileStatements()
         self._expect(type=T_SYMBOL, values=["}"])
-        self._close_tag(tag="subroutineBody")
-        self._close_tag(tag="subroutineDec")
+        return SubroutineDec(kind, return_type, name, parameters, var_decs, statements)
 
     def compileParameterList(self):
         #
         # 次のトークンが")"記号であればリストの終わりとみなす
         #
         tk = self.tokenizer
-        self._open_tag(tag="parameterList")
-        if tk.next_token.value == ")":
-            pass
-        else:
-            first = True
-            while tk.next_token.value != ")":
-                if not first: self._expect(type=T_SYMBOL, values=[","])
-                if tk.next_token.type == T_KEYWORD:
-                    self._expect(type=T_KEYWORD, values=["int", "char", "boolean"])
-                else:
-                    self._expect(type=T_IDENTIFIER)
-                self._expect(type=T_IDENTIFIER)
-                first = False
-        self._close_tag(tag="parameterList")
+        parameters = []
+        while tk.next_token.value != ")":
+            if parameters: self._expect(type=T_SYMBOL, values=[","])
+            type = self._type(["int", "char", "boolean"])
+            parameters.append((type, self._expect(type=T_IDENTIFIER)))
+        return parameters
 
     def compileVarDec(self):
         tk = self.tokenizer
-        self._open_tag(tag="varDec")
         self._expect(type=T_KEYWORD, values=["var"])
-        if tk.next_token.type == T_KEYWORD:
-            self._expect(type=T_KEYWORD, values=["int", "char", "boolean"])
-        else:
-            self._expect(type=T_IDENTIFIER)
-        first = True
+        type = self._type(["int", "char", "boolean"])
+        names = []
         while tk.next_token.value != ";":
-            if not first: self._expect(type=T_SYMBOL, values=[","])
-            self._expect(type=T_IDENTIFIER)
-            first = False
+            if names: self._expect(type=T_SYMBOL, values=[","])
+            names.append(self._expect(type=T_IDENTIFIER))
         self._expect(type=T_SYMBOL, values=[";"])
-        self._close_tag(tag="varDec")
+        return VarDec(type, names)
 
     def compileStatements(self):
         tk = self.tokenizer
-        self._open_tag(tag="statements")
+        statements = []
         while tk.next_token.value in ["let", "if", "while", "do", "return"]:
             next_val = tk.next_token.value
             if next_val == "let":
-                self.compileLet()
+                statements.append(self.compileLet())
             elif next_val == "if":
-                self.compileIf()
+                statements.append(self.compileIf())
             elif next_val == "while":
-                self.compileWhile()
+                statements.append(self.compileWhile())
             elif next_val == "do":
-                self.compileDo()
+                statements.append(self.compileDo())
             elif next_val == "return":
-                self.compileReturn()
-        self._close_tag(tag="statements")
+                statements.append(self.compileReturn())
+        return statements
 
     def compileDo(self):
-        tk = self.tokenizer
-        self._open_tag(tag="doStatement")
         self._expect(type=T_KEYWORD, values=["do"])
         # subroutineCall
-        self._expect(type=T_IDENTIFIER) # subroutineName or (className|varName)
-        if tk.next_token.value == "(":
-            self._expect(type=T_SYMBOL, values=["("])
-            self.compileExpressionList()
-            self._expect(type=T_SYMBOL, values=[")"])
-        elif tk.next_token.value == ".":
-            self._expect(type=T_SYMBOL, values=["."])
-            self._expect(type=T_IDENTIFIER)
-            self._expect(type=T_SYMBOL, values=["("])
-            self.compileExpressionList()
-            self._expect(type=T_SYMBOL, values=[")"])
+        call = self.compileSubroutineCall(self._expect(type=T_IDENTIFIER))
         self._expect(type=T_SYMBOL, values=[";"])
-        self._close_tag(tag="doStatement")
+        return DoStatement(call)
+
+    def compileSubroutineCall(self, name):
+        #
+        # subroutineCallの最初のidentifier(name)を読んだ後の部分を解析する
+        #
+        receiver = None
+        if self.tokenizer.next_token.value == ".":
+            self._expect(type=T_SYMBOL, values=["."])
+            receiver, name = name, self._expect(type=T_IDENTIFIER)
+        self._expect(type=T_SYMBOL, values=["("])
+        arguments = self.compileExpressionList()
+        self._expect(type=T_SYMBOL, values=[")"])
+        return SubroutineCall(receiver, name, arguments)
 
     def compileLet(self):
         tk = self.tokenizer
-        self._open_tag(tag="letStatement")
         self._expect(type=T_KEYWORD, values=["let"])
-        self._expect(type=T_IDENTIFIER)  # varName
+        name = self._expect(type=T_IDENTIFIER)  # varName
+        index = None
         if tk.next_token.value == "[":
             self._expect(type=T_SYMBOL, values=["["])
-            self.compileExpression()
+            index = self.compileExpression()
             self._expect(type=T_SYMBOL, values=["]"])
         self._expect(type=T_SYMBOL, values=["="])
-        self.compileExpression()
+        value = self.compileExpression()
         self._expect(type=T_SYMBOL, values=[";"])
-        self._close_tag(tag="letStatement")
+        return LetStatement(name, index, value)
 
     def compileWhile(self):
-        tk = self.tokenizer
-        self._open_tag(tag="whileStatement")
         self._expect(type=T_KEYWORD, values=["while"])
         self._expect(type=T_SYMBOL, values=["("])
-        self.compileExpression()
+        condition = self.compileExpression()
         self._expect(type=T_SYMBOL, values=[")"])
         self._expect(type=T_SYMBOL, values=["{"])
-        self.compileStatements()
+        statements = self.compileStatements()
         self._expect(type=T_SYMBOL, values=["}"])
-        self._close_tag(tag="whileStatement")
+        return WhileStatement(condition, statements)
 
     def compileReturn(self):
         tk = self.tokenizer
-        self._open_tag(tag="returnStatement")
         self._expect(type=T_KEYWORD, values=["return"])
+        value = None
         if tk.next_token.value != ";":
-            self.compileExpression()
+            value = self.compileExpression()
         self._expect(type=T_SYMBOL, values=[";"])
-        self._close_tag(tag="returnStatement")
+        return ReturnStatement(value)
 
     def compileIf(self):
         tk = self.tokenizer
-        self._open_tag(tag="ifStatement")
         self._expect(type=T_KEYWORD, values=["if"])
         self._expect(type=T_SYMBOL, values=["("])
-        self.compileExpression()
+        condition = self.compileExpression()
         self._expect(type=T_SYMBOL, values=[")"])
         self._expect(type=T_SYMBOL, values=["{"])
-        self.compileStatements()
+        statements = self.compileStatements()
         self._expect(type=T_SYMBOL, values=["}"])
+        else_statements = None
         if tk.next_token.value == "else":
             self._expect(type=T_KEYWORD, values=["else"])
             self._expect(type=T_SYMBOL, values=["{"])
-            self.compileStatements()
+            else_statements = self.compileStatements()
             self._expect(type=T_SYMBOL, values=["}"])
-        self._close_tag(tag="ifStatement")
+        return IfStatement(condition, statements, else_statements)
 
     def compileExpression(self):
         tk = self.tokenizer
-        self._open_tag(tag="expression")
-        self.compileTerm()
+        terms = [self.compileTerm()]
+        ops = []
         while tk.next_token.value in Jack_operators:
-            self._expect(type=T_SYMBOL, values=Jack_operators)
-            self.compileTerm()
-        self._close_tag(tag="expression")
+            ops.append(self._expect(type=T_SYMBOL, values=Jack_operators))
+            terms.append(self.compileTerm())
+        return Expression(terms, ops)
 
     def compileTerm(self):
         tk = self.tokenizer
-        self._open_tag(tag="term")
         next_type = tk.next_token.type
         next_value = tk.next_token.value
         if next_type == T_INT_CONST:   # integerConstant
-            self._expect(type=T_INT_CONST)
+            return IntegerConstant(self._expect(type=T_INT_CONST))
         elif next_type == T_STR_CONST:   # stringConstant
-            self._expect(type=T_STR_CONST)
+            return StringConstant(self._expect(type=T_STR_CONST))
         elif next_value in Jack_kw_constants:   # KeywordConstant
-            self._expect(type=T_KEYWORD, values=Jack_kw_constants)
+            return KeywordConstant(self._expect(type=T_KEYWORD, values=Jack_kw_constants))
         elif next_value == "(":  # (expression)
             self._expect(type=T_SYMBOL, values=["("])
-            self.compileExpression()
+            expression = self.compileExpression()
             self._expect(type=T_SYMBOL, values=[")"])
+            return ParenTerm(expression)
         elif next_value in Jack_unary_ops:   # unaryOp term
-            self._expect(type=T_SYMBOL, values=Jack_unary_ops)
-            self.compileTerm()
+            op = self._expect(type=T_SYMBOL, values=Jack_unary_ops)
+            return UnaryTerm(op, self.compileTerm())
         elif next_type == T_IDENTIFIER:   # varName | varName[expression] | subroutineCall
-            self._expect(type=T_IDENTIFIER)
+            name = self._expect(type=T_IDENTIFIER)
             if tk.next_token.value == "[":   # varName[expression]
                 self._expect(type=T_SYMBOL, values=["["])
-                self.compileExpression()
+                index = self.compileExpression()
                 self._expect(type=T_SYMBOL, values=["]"])
+                return ArrayTerm(name, index)
             elif tk.next_token.value in ["(", "."]:   # subroutineCall
-                if tk.next_token.value == "(":
-                    self._expect(type=T_SYMBOL, values=["("])
-                    self.compileExpressionList()
-                    self._expect(type=T_SYMBOL, values=[")"])
-                elif tk.next_token.value == ".":
-                    self._expect(type=T_SYMBOL, values=["."])
-                    self._expect(type=T_IDENTIFIER)
-                    self._expect(type=T_SYMBOL, values=["("])
-                    self.compileExpressionList()
-                    self._expect(type=T_SYMBOL, values=[")"])
+                return self.compileSubroutineCall(name)
             else:   # varName
-                pass
-        self._close_tag(tag="term")
+                return VarTerm(name)
+        raise RuntimeError("Unexpected token in term: " + next_value)
 
     def compileExpressionList(self):
         #
         # 次のトークンが")"記号であればリストの終わりとみなす
         #
         tk = self.tokenizer
-        self._open_tag(tag="expressionList")
-        if tk.next_token.value == ")":
-            pass
-        else:
-            first = True
-            while tk.next_token.value != ")":
-                if not first:
-                    self._expect(type=T_SYMBOL, values=[","])
-                first = False
-                self.compileExpression()
-        self._close_tag(tag="expressionList")
+        expressions = []
+        while tk.next_token.value != ")":
+            if expressions:
+                self._expect(type=T_SYMBOL, values=[","])
+            expressions.append(self.compileExpression())
+        return expressions
+
+
+class XMLWriter():
+    #
+    # ASTをreferenceと同じ形式のxmlに変換する
+    #
+    def __init__(self):
+        self.lines = []
+        self.indent = "  "
+        self.indent_level = 0
+        self.pad = "" # 現在のインデント文字列（indent * indent_level）
+
+    def write(self, tree, xml_file):
+        #
+        # ClassDecをxmlファイルに書き出す
+        #
+        self.lines = []
+        self.indent_level = 0
+        self.pad = ""
+        self.writeClass(tree)
+        with open(xml_file, "w") as fout:
+            fout.write("".join(self.lines))
+
+    def _to_xml(self, tag, val):
+        #
+        # 終端記号をxml形式で出力: <tag> val </tag>
+        #
+        self.lines.append(self.pad + "<" + tag + "> " + XML_ESCAPES.get(val, val) + " </" + tag + ">\n")
+
+    def _open_tag(self, tag):
+        #
+        # 非終端記号の開タグを出力
+        #
+        self.lines.append(self.pad + "<" + tag + ">\n")
+        self.indent_level += 1
+        self.pad = self.indent * self.indent_level
+
+    def _close_tag(self, tag):
+        #
+        # 非終端記号の閉タグを出力
+        #
+        self.indent_level -= 1
+        self.pad = self.indent * self.indent_level
+        self.lines.append(self.pad + "</" + tag + ">\n")
+
+    def _type(self, type):
+        self._to_xml(T_KEYWORD if type in Jack_keywords else T_IDENTIFIER, type)
+
+    def writeClass(self, node):
+        self._open_tag("class")
+        self._to_xml(T_KEYWORD, "class")
+        self._to_xml(T_IDENTIFIER, node.name)
+        self._to_xml(T_SYMBOL, "{")
+        for dec in node.class_var_decs:
+            self._open_tag("classVarDec")
+            self._to_xml(T_KEYWORD, dec.kind)
+            self._type(dec.type)
+            self._names(dec.names)
+            self._to_xml(T_SYMBOL, ";")
+            self._close_tag("classVarDec")
+        for dec in node.subroutine_decs:
+            self.writeSubroutine(dec)
+        self._to_xml(T_SYMBOL, "}")
+        self._close_tag("class")
+
+    def _names(self, names):
+        for i, name in enumerate(names):
+            if i: self._to_xml(T_SYMBOL, ",")
+            self._to_xml(T_IDENTIFIER, name)
+
+    def writeSubroutine(self, node):
+        self._open_tag("subroutineDec")
+        self._to_xml(T_KEYWORD, node.kind)
+        self._type(node.return_type)
+        self._to_xml(T_IDENTIFIER, node.name)
+        self._to_xml(T_SYMBOL, "(")
+        self._open_tag("parameterList")
+        for i, (type, name) in enumerate(node.parameters):
+            if i: self._to_xml(T_SYMBOL, ",")
+            self._type(type)
+            self._to_xml(T_IDENTIFIER, name)
+        self._close_tag("parameterList")
+        self._to_xml(T_SYMBOL, ")")
+        self._open_tag("subroutineBody")
+        self._to_xml(T_SYMBOL, "{")
+        for dec in node.var_decs:
+            self._open_tag("varDec")
+            self._to_xml(T_KEYWORD, "var")
+            self._type(dec.type)
+            self._names(dec.names)
+            self._to_xml(T_SYMBOL, ";")
+            self._close_tag("varDec")
+        self.writeStatements(node.statements)
+        self._to_xml(T_SYMBOL, "}")
+        self._close_tag("subroutineBody")
+        self._close_tag("subroutineDec")
+
+    def writeStatements(self, statements):
+        self._open_tag("statements")
+        for statement in statements:
+            if type(statement) is LetStatement:
+                self._open_tag("letStatement")
+                self._to_xml(T_KEYWORD, "let")
+                self._to_xml(T_IDENTIFIER, statement.name)
+                if statement.index is not None:
+                    self._to_xml(T_SYMBOL, "[")
+                    self.writeExpression(statement.index)
+                    self._to_xml(T_SYMBOL, "]")
+                self._to_xml(T_SYMBOL, "=")
+                self.writeExpression(statement.value)
+                self._to_xml(T_SYMBOL, ";")
+                self._close_tag("letStatement")
+            elif type(statement) is IfStatement:
+                self._open_tag("ifStatement")
+                self._to_xml(T_KEYWORD, "if")
+                self._condition(statement.condition)
+                self._block(statement.statements)
+                if statement.else_statements is not None:
+                    self._to_xml(T_KEYWORD, "else")
+                    self._block(statement.else_statements)
+                self._close_tag("ifStatement")
+            elif type(statement) is WhileStatement:
+                self._open_tag("whileStatement")
+                self._to_xml(T_KEYWORD, "while")
+                self._condition(statement.condition)
+                self._block(statement.statements)
+                self._close_tag("whileStatement")
+            elif type(statement) is DoStatement:
+                self._open_tag("doStatement")
+                self._to_xml(T_KEYWORD, "do")
+                self.writeSubroutineCall(statement.call)
+                self._to_xml(T_SYMBOL, ";")
+                self._close_tag("doStatement")
+            elif type(statement) is ReturnStatement:
+                self._open_tag("returnStatement")
+                self._to_xml(T_KEYWORD, "return")
+                if statement.value is not None:
+                    self.writeExpression(statement.value)
+                self._to_xml(T_SYMBOL, ";")
+                self._close_tag("returnStatement")
+        self._close_tag("statements")
+
+    def _condition(self, expression):
+        self._to_xml(T_SYMBOL, "(")
+        self.writeExpression(expression)
+        self._to_xml(T_SYMBOL, ")")
+
+    def _block(self, statements):
+        self._to_xml(T_SYMBOL, "{")
+        self.writeStatements(statements)
+        self._to_xml(T_SYMBOL, "}")
+
+    def writeSubroutineCall(self, node):
+        if node.receiver is not None:
+            self._to_xml(T_IDENTIFIER, node.receiver)
+            self._to_xml(T_SYMBOL, ".")
+        self._to_xml(T_IDENTIFIER, node.name)
+        self._to_xml(T_SYMBOL, "(")
+        self._open_tag("expressionList")
+        for i, expression in enumerate(node.arguments):
+            if i: self._to_xml(T_SYMBOL, ",")
+            self.writeExpression(expression)
+        self._close_tag("expressionList")
+        self._to_xml(T_SYMBOL, ")")
+
+    def writeExpression(self, node):
+        self._open_tag("expression")
+        self.writeTerm(node.terms[0])
+        for op, term in zip(node.ops, node.terms[1:]):
+            self._to_xml(T_SYMBOL, op)
+            self.writeTerm(term)
+        self._close_tag("expression")
+
+    def writeTerm(self, node):
+        self._open_tag("term")
+        node_type = type(node)
+        if node_type is IntegerConstant:
+            self._to_xml(T_INT_CONST, node.value)
+        elif node_type is StringConstant:
+            self._to_xml(T_STR_CONST, node.value)
+        elif node_type is KeywordConstant:
+            self._to_xml(T_KEYWORD, node.value)
+        elif node_type is VarTerm:
+            self._to_xml(T_IDENTIFIER, node.name)
+        elif node_type is ArrayTerm:
+            self._to_xml(T_IDENTIFIER, node.name)
+            self._to_xml(T_SYMBOL, "[")
+            self.writeExpression(node.index)
+            self._to_xml(T_SYMBOL, "]")
+        elif node_type is SubroutineCall:
+            self.writeSubroutineCall(node)
+        elif node_type is ParenTerm:
+            self._to_xml(T_SYMBOL, "(")
+            self.writeExpression(node.expression)
+            self._to_xml(T_SYMBOL, ")")
+        elif node_type is UnaryTerm:
+            self._to_xml(T_SYMBOL, node.op)
+            self.writeTerm(node.term)
+        self._close_tag("term")
 
 #
 # Main program
 #
-parser = argparse.ArgumentParser()
-parser.add_argument("--source", required=True, help="Source file or directory")
-args = parser.parse_args()
-source = args.source
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", required=True, help="Source file or directory")
+    parser.add_argument("--lazy", action="store_true", help="Tokenize on demand while parsing (streaming mode)")
+    parser.add_argument("--no-xml", action="store_true", help="Only parse the sources into ASTs; do not write .xml files")
+    args = parser.parse_args(argv)
+    source = args.source
+
+    analyzer = JackAnalyzer(source, lazy=args.lazy, xml=not args.no_xml)
+    analyzer.run()
+
 
-analyzer = JackAnalyzer(source)
-analyzer.run()
+if __name__ == "__main__":
+    main()
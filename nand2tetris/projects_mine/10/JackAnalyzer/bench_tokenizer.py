@@ -0,0 +1,104 @@
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+
+from JackAnalyzer import Token, JackTokenizer
+
+#
+# JackTokenizerの字句解析の速度（tokens/s）を以前の方式と比較する
+#   before ... 以前の方式。トークナイザの生成ごとに正規表現を組み立て、keywordは正規表現の選択肢でマッチさせる
+#   after  ... JackAnalyzer.JackTokenizer（モジュール読み込み時にコンパイルした正規表現とfrozensetでのkeyword判定）
+# 以前の方式でトークナイズできないファイル（classifyのような識別子を含むもの）は両方の計測から除く
+#
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+
+legacy_specification = [
+    ("COMMENT1", r"//.*"),
+    ("COMMENT2", r"/\*[\s\S]*?\*/"),
+    ("COMMENT3", r"/\*\*[\s\S]*?\*/"),
+    ("stringConstant", r"\".*?\""),
+    ("SKIP", r"\s+|\n+"),
+    ("symbol", r"[{}\(\)\[\],.;\+\-\*/&\|<>=~]"),
+    ("keyword", r"class|constructor|function|method|field|static|var|int|char|boolean|void|true|false|null|this|let|do|if|else|while|return"),
+    ("identifier", r"\b[a-zA-Z_][a-zA-Z0-9_]*\b"),
+    ("integerConstant", r"\b\d+\b"),
+    ("MISMATCH", r"."),
+]
+
+def legacy_tokenize(source_file):
+    #
+    # 以前のJackTokenizer.__init__()と同じ処理でトークンのタプルを返す
+    #
+    with open(source_file, "r") as fin:
+        source_text = fin.read()
+    tmp_list = []
+    tok_regex = "|".join("(?P<%s>%s)" % pair for pair in legacy_specification)
+    for mo in re.finditer(tok_regex, source_text):
+        type = mo.lastgroup
+        value = mo.group()
+        if type in ["COMMENT1", "COMMENT2", "COMMENT3", "SKIP"]:
+            continue
+        elif type in ["symbol", "keyword", "stringConstant", "integerConstant", "identifier"]:
+            value = value.replace('"', '')
+            tmp_list.append(Token(type, value))
+        else:
+            raise RuntimeError(f"{value!r} unexpected.")
+    return tuple(tmp_list)
+
+def current_tokenize(source_file):
+    return JackTokenizer(source_file).tokens
+
+def measure(tokenize, files, repeat):
+    #
+    # 全ファイルのトークナイズをrepeat回行い、(トークン数, 最良の所要時間[s])を返す
+    #
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = 0
+        for source_file in files:
+            count += len(tokenize(source_file))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Jack tokenizer benchmark")
+    parser.add_argument("--source", nargs="+", default=None,
+                        help="Source files or directories (default: every .jack file under 10/, 11/ and 12/)")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs; the best one is reported")
+    args = parser.parse_args(argv)
+
+    if args.source is None:
+        files = sorted(glob.glob(os.path.join(PROJECTS_DIR, "1[012]", "**", "*.jack"), recursive=True))
+    else:
+        files = []
+        for source in args.source:
+            if os.path.isdir(source):
+                files.extend(sorted(glob.glob(os.path.join(source, "**", "*.jack"), recursive=True)))
+            else:
+                files.append(source)
+
+    # 以前の方式でトークナイズできるファイルだけを比較に使う
+    comparable = []
+    for source_file in files:
+        try:
+            legacy_tokenize(source_file)
+        except RuntimeError:
+            continue
+        comparable.append(source_file)
+    print("%d of %d file(s) can be tokenized by the legacy lexer" % (len(comparable), len(files)))
+    if not comparable:
+        sys.exit(1)
+
+    for label, tokenize in [("before", legacy_tokenize), ("after", current_tokenize)]:
+        count, best = measure(tokenize, comparable, args.repeat)
+        print("%-7s %7d tokens %8.1f ms %10.0f tokens/s" % (label, count, best*1000, count/best))
+
+
+if __name__ == "__main__":
+    main()
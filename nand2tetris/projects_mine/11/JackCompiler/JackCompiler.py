@@ -0,0 +1,371 @@
+import os
+import sys
+import glob
+import argparse
+import collections
+
+#
+# 10章のJackTokenizerとCompilationEngine（AST）を再利用する
+#
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "10", "JackAnalyzer"))
+from JackAnalyzer import (JackTokenizer, CompilationEngine,
+                          LetStatement, IfStatement, WhileStatement, DoStatement, ReturnStatement,
+                          IntegerConstant, StringConstant, KeywordConstant, VarTerm, ArrayTerm,
+                          SubroutineCall, ParenTerm, UnaryTerm)
+
+#
+# Symbol container
+#
+Symbol = collections.namedtuple("Symbol", ["type", "kind", "index"])
+
+#
+# Symbol kinds
+#
+K_STATIC = "static"
+K_FIELD  = "field"
+K_ARG    = "arg"
+K_VAR    = "var"
+
+#
+# VM segments
+#
+S_CONST   = "constant"
+S_ARG     = "argument"
+S_LOCAL   = "local"
+S_STATIC  = "static"
+S_THIS    = "this"
+S_THAT    = "that"
+S_POINTER = "pointer"
+S_TEMP    = "temp"
+
+kind_to_segment = {K_STATIC: S_STATIC, K_FIELD: S_THIS, K_ARG: S_ARG, K_VAR: S_LOCAL}
+
+#
+# Jack operators -> VM commands
+#
+binary_ops = {"+": "add", "-": "sub", "&": "and", "|": "or", "<": "lt", ">": "gt", "=": "eq",
+              "*": "call Math.multiply 2", "/": "call Math.divide 2"}
+unary_ops = {"-": "neg", "~": "not"}
+
+#
+# Class definitions
+#
+class JackCompiler():
+    def __init__(self, sources):
+        #
+        # sourcesはディレクトリまたはJackソースファイル名のリスト
+        #
+        self.src_files = []
+        for source in sources:
+            if os.path.isdir(source):
+                self.src_files.extend(sorted(glob.glob(os.path.join(source, "*.jack"))))
+            elif os.path.isfile(source):
+                if not source.endswith(".jack"):
+                    raise ValueError("Input file "+source+" may not be a jack source file?")
+                self.src_files.append(source)
+            else:
+                raise FileNotFoundError("Jack source file(s) not found !")
+
+    def run(self):
+        for src_file in self.src_files:
+            print("Compiling "+src_file)
+            # Parse into an AST
+            tree = CompilationEngine(JackTokenizer(src_file)).compileClass()
+            # Generate VM code
+            writer = VMWriter(src_file.replace(".jack", ".vm"))
+            CodeGenerator(writer).compileClass(tree)
+            writer.close()
+        print("Compilation ended successfully.")
+
+
+class SymbolTable():
+    def __init__(self):
+        #
+        # クラススコープのシンボルテーブルを初期化
+        #
+        self.class_table = {}
+        self.subroutine_table = {}
+        self.counts = {K_STATIC: 0, K_FIELD: 0, K_ARG: 0, K_VAR: 0}
+
+    def startSubroutine(self):
+        #
+        # サブルーチンスコープのテーブルを初期化
+        #
+        self.subroutine_table = {}
+        self.counts[K_ARG] = 0
+        self.counts[K_VAR] = 0
+
+    def define(self, name, type, kind):
+        #
+        # 新しいシンボルを登録する。同じスコープに登録済みの名前ならエラー
+        #
+        table = self.class_table if kind in (K_STATIC, K_FIELD) else self.subroutine_table
+        if name in table:
+            raise RuntimeError("Duplicate declaration: " + name)
+        table[name] = Symbol(type, kind, self.varCount(kind))
+        self.counts[kind] += 1
+
+    def varCount(self, kind):
+        return self.counts[kind]
+
+    def _lookup(self, name):
+        #
+        # サブルーチンスコープ、クラススコープの順に探す。見つからなければNone
+        #
+        symbol = self.subroutine_table.get(name)
+        if symbol is None:
+            symbol = self.class_table.get(name)
+        return symbol
+
+    def kindOf(self, name):
+        symbol = self._lookup(name)
+        return symbol.kind if symbol else ""
+
+    def typeOf(self, name):
+        symbol = self._lookup(name)
+        return symbol.type if symbol else ""
+
+    def indexOf(self, name):
+        symbol = self._lookup(name)
+        return symbol.index if symbol else ""
+
+
+class VMWriter():
+    def __init__(self, vm_file):
+        #
+        # 出力する行はリストに貯めてclose()でまとめて書き込む
+        #
+        self.vm_file = vm_file
+        self.lines = []
+
+    def writePush(self, segment, index):
+        self.lines.append("push " + segment + " " + str(index) + "\n")
+
+    def writePop(self, segment, index):
+        self.lines.append("pop " + segment + " " + str(index) + "\n")
+
+    def writeArithmetic(self, command):
+        self.lines.append(command + "\n")
+
+    def writeLabel(self, label):
+        self.lines.append("label " + label + "\n")
+
+    def writeGoto(self, label):
+        self.lines.append("goto " + label + "\n")
+
+    def writeIf(self, label):
+        self.lines.append("if-goto " + label + "\n")
+
+    def writeCall(self, name, nargs):
+        self.lines.append("call " + name + " " + str(nargs) + "\n")
+
+    def writeFunction(self, name, nlocals):
+        self.lines.append("function " + name + " " + str(nlocals) + "\n")
+
+    def writeReturn(self):
+        self.lines.append("return\n")
+
+    def close(self):
+        with open(self.vm_file, "w") as fout:
+            fout.write("".join(self.lines))
+
+
+class CodeGenerator():
+    def __init__(self, writer):
+        #
+        # CompilationEngineが作ったASTをたどってVMコードをwriterに出力する
+        #
+        self.writer = writer
+        self.symbols = SymbolTable()
+        self.class_name = ""
+        self.label_id = 0
+
+    def _genLabel(self, prefix):
+        #
+        # サブルーチン内でユニークなラベルを返す
+        #
+        self.label_id += 1
+        return prefix + str(self.label_id)
+
+    def compileClass(self, node):
+        self.class_name = node.name
+        for dec in node.class_var_decs:
+            for name in dec.names:
+                self.symbols.define(name, dec.type, dec.kind)
+        for dec in node.subroutine_decs:
+            self.compileSubroutine(dec)
+
+    def compileSubroutine(self, node):
+        st = self.symbols
+        wr = self.writer
+        st.startSubroutine()
+        self.label_id = 0
+        # methodの第0引数はthis
+        if node.kind == "method":
+            st.define("this", self.class_name, K_ARG)
+        for type, name in node.parameters:
+            st.define(name, type, K_ARG)
+        for dec in node.var_decs:
+            for name in dec.names:
+                st.define(name, dec.type, K_VAR)
+        wr.writeFunction(self.class_name + "." + node.name, st.varCount(K_VAR))
+        if node.kind == "constructor":
+            # フィールドの数だけメモリを確保してthisに設定
+            wr.writePush(S_CONST, st.varCount(K_FIELD))
+            wr.writeCall("Memory.alloc", 1)
+            wr.writePop(S_POINTER, 0)
+        elif node.kind == "method":
+            wr.writePush(S_ARG, 0)
+            wr.writePop(S_POINTER, 0)
+        self.compileStatements(node.statements)
+
+    def compileStatements(self, statements):
+        wr = self.writer
+        for statement in statements:
+            statement_type = type(statement)
+            if statement_type is LetStatement:
+                if statement.index is None:
+                    self.compileExpression(statement.value)
+                    self._pop(statement.name)
+                else:
+                    # アドレスを先に計算し、値をtemp 0に退避してからthatで書き込む
+                    self._push(statement.name)
+                    self.compileExpression(statement.index)
+                    wr.writeArithmetic("add")
+                    self.compileExpression(statement.value)
+                    wr.writePop(S_TEMP, 0)
+                    wr.writePop(S_POINTER, 1)
+                    wr.writePush(S_TEMP, 0)
+                    wr.writePop(S_THAT, 0)
+            elif statement_type is IfStatement:
+                else_label = self._genLabel("IF_ELSE")
+                self.compileExpression(statement.condition)
+                wr.writeArithmetic("not")
+                wr.writeIf(else_label)
+                self.compileStatements(statement.statements)
+                if statement.else_statements:
+                    end_label = self._genLabel("IF_END")
+                    wr.writeGoto(end_label)
+                    wr.writeLabel(else_label)
+                    self.compileStatements(statement.else_statements)
+                    wr.writeLabel(end_label)
+                else:
+                    wr.writeLabel(else_label)
+            elif statement_type is WhileStatement:
+                loop_label = self._genLabel("WHILE_EXP")
+                end_label = self._genLabel("WHILE_END")
+                wr.writeLabel(loop_label)
+                self.compileExpression(statement.condition)
+                wr.writeArithmetic("not")
+                wr.writeIf(end_label)
+                self.compileStatements(statement.statements)
+                wr.writeGoto(loop_label)
+                wr.writeLabel(end_label)
+            elif statement_type is DoStatement:
+                self.compileSubroutineCall(statement.call)
+                wr.writePop(S_TEMP, 0) # 戻り値は捨てる
+            elif statement_type is ReturnStatement:
+                if statement.value is None:
+                    wr.writePush(S_CONST, 0) # voidでも値を1つ返す
+                else:
+                    self.compileExpression(statement.value)
+                wr.writeReturn()
+            else:
+                raise RuntimeError("Unknown statement: " + statement_type.__name__)
+
+    def _push(self, name):
+        st = self.symbols
+        wr = self.writer
+        kind = st.kindOf(name)
+        if not kind:
+            raise RuntimeError("Undefined variable: " + name + " in class " + self.class_name)
+        wr.writePush(kind_to_segment[kind], st.indexOf(name))
+
+    def _pop(self, name):
+        st = self.symbols
+        wr = self.writer
+        kind = st.kindOf(name)
+        if not kind:
+            raise RuntimeError("Undefined variable: " + name + " in class " + self.class_name)
+        wr.writePop(kind_to_segment[kind], st.indexOf(name))
+
+    def compileExpression(self, node):
+        wr = self.writer
+        self.compileTerm(node.terms[0])
+        for op, term in zip(node.ops, node.terms[1:]):
+            self.compileTerm(term)
+            wr.writeArithmetic(binary_ops[op])
+
+    def compileTerm(self, node):
+        wr = self.writer
+        node_type = type(node)
+        if node_type is IntegerConstant:
+            wr.writePush(S_CONST, node.value)
+        elif node_type is VarTerm:
+            self._push(node.name)
+        elif node_type is SubroutineCall:
+            self.compileSubroutineCall(node)
+        elif node_type is ArrayTerm:
+            self._push(node.name)
+            self.compileExpression(node.index)
+            wr.writeArithmetic("add")
+            wr.writePop(S_POINTER, 1)
+            wr.writePush(S_THAT, 0)
+        elif node_type is ParenTerm:
+            self.compileExpression(node.expression)
+        elif node_type is UnaryTerm:
+            self.compileTerm(node.term)
+            wr.writeArithmetic(unary_ops[node.op])
+        elif node_type is KeywordConstant:
+            if node.value == "this":
+                wr.writePush(S_POINTER, 0)
+            elif node.value == "true":
+                wr.writePush(S_CONST, 0)
+                wr.writeArithmetic("not")
+            else: # false, null
+                wr.writePush(S_CONST, 0)
+        elif node_type is StringConstant:
+            wr.writePush(S_CONST, len(node.value))
+            wr.writeCall("String.new", 1)
+            for c in node.value:
+                wr.writePush(S_CONST, ord(c))
+                wr.writeCall("String.appendChar", 2)
+        else:
+            raise RuntimeError("Unknown term: " + node_type.__name__)
+
+    def compileSubroutineCall(self, node):
+        st = self.symbols
+        wr = self.writer
+        nargs = len(node.arguments)
+        if node.receiver is None:
+            # 自クラスのmethod呼び出し
+            wr.writePush(S_POINTER, 0)
+            name = self.class_name + "." + node.name
+            nargs += 1
+        elif st.kindOf(node.receiver):
+            # 変数が指すオブジェクトのmethod呼び出し
+            self._push(node.receiver)
+            name = st.typeOf(node.receiver) + "." + node.name
+            nargs += 1
+        else:
+            # function, constructorの呼び出し
+            name = node.receiver + "." + node.name
+        for expression in node.arguments:
+            self.compileExpression(expression)
+        wr.writeCall(name, nargs)
+
+
+#
+# Main program
+#
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", required=True, nargs="+", help="Source file(s) or directory(ies)")
+    args = parser.parse_args(argv)
+
+    compiler = JackCompiler(args.source)
+    compiler.run()
+
+
+if __name__ == "__main__":
+    main()
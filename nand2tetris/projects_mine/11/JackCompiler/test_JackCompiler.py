@@ -0,0 +1,98 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import JackCompiler
+from JackCompiler import JackTokenizer, CompilationEngine
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def compile_file(src_file):
+    #
+    # .jackファイルをコンパイルし、VMコマンドのリストを返す（.vmファイルは書き込まない）
+    #
+    tree = CompilationEngine(JackTokenizer(src_file)).compileClass()
+    writer = JackCompiler.VMWriter(None)
+    JackCompiler.CodeGenerator(writer).compileClass(tree)
+    return [line.rstrip("\n") for line in writer.lines]
+
+
+class CompileProgramTest(unittest.TestCase):
+    def test_seven(self):
+        commands = compile_file(os.path.join(PROJECT_DIR, "Seven", "Main.jack"))
+        self.assertEqual(commands, ["function Main.main 0",
+                                    "push constant 1",
+                                    "push constant 2",
+                                    "push constant 3",
+                                    "call Math.multiply 2",
+                                    "add",
+                                    "call Output.printInt 1",
+                                    "pop temp 0",
+                                    "push constant 0",
+                                    "return"])
+
+    def test_convert_to_bin_labels(self):
+        # ラベルは関数内でユニークで、goto, if-gotoの飛び先は同じ関数内に定義されていること
+        commands = compile_file(os.path.join(PROJECT_DIR, "ConvertToBin", "Main.jack"))
+        functions = []
+        for command in commands:
+            if command.startswith("function "):
+                functions.append([])
+            functions[-1].append(command.split())
+        for function in functions:
+            labels = [c[1] for c in function if c[0] == "label"]
+            targets = {c[1] for c in function if c[0] in ("goto", "if-goto")}
+            self.assertEqual(len(labels), len(set(labels)), function[0])
+            self.assertLessEqual(targets, set(labels), function[0])
+        self.assertTrue(any(c[0] == "label" for function in functions for c in function))
+
+
+class CompileSourceTest(unittest.TestCase):
+    def _compile(self, source):
+        with tempfile.TemporaryDirectory() as tmp:
+            src_file = os.path.join(tmp, "Point.jack")
+            with open(src_file, "w") as fout:
+                fout.write(source)
+            return compile_file(src_file)
+
+    def test_constructor_and_method_prologue(self):
+        commands = self._compile("""
+class Point {
+    field int x, y;
+    static int count;
+    constructor Point new(int ax, int ay) {
+        let x = ax;
+        let y = ay;
+        return this;
+    }
+    method int getY(int dummy) {
+        return y;
+    }
+}
+""")
+        # constructorはフィールド数(2)を確保、methodはargument 0をthisにする
+        self.assertEqual(commands[:6], ["function Point.new 0",
+                                        "push constant 2",
+                                        "call Memory.alloc 1",
+                                        "pop pointer 0",
+                                        "push argument 0",
+                                        "pop this 0"])
+        method = commands[commands.index("function Point.getY 0"):]
+        self.assertEqual(method, ["function Point.getY 0",
+                                  "push argument 0",
+                                  "pop pointer 0",
+                                  "push this 1",
+                                  "return"])
+
+    def test_duplicate_declaration(self):
+        with self.assertRaises(RuntimeError):
+            self._compile("class Point { field int x; static int x; }")
+        with self.assertRaises(RuntimeError):
+            self._compile("class Point { function void f(int a) { var int a; return; } }")
+
+
+if __name__ == "__main__":
+    unittest.main()